@@ -0,0 +1,201 @@
+##################################################
+# IN-PROCESS CACHES
+##################################################
+
+import time
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+  """
+  Thread safe least-recently-used cache. Entries expire ttl seconds after
+  they are set (never if ttl is None) and the least recently read entry is
+  evicted once max_size is exceeded.
+  """
+
+  def __init__(self, max_size=1024, ttl=None, clock=time.time):
+    self.max_size = max_size
+    self.ttl      = ttl
+    self.clock    = clock
+    self._entries = OrderedDict()
+    self._lock    = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        return default
+      value, expires = entry
+      if expires is not None and expires <= self.clock():
+        return default
+      self._entries[key] = entry
+      return value
+
+  def set(self, key, value, ttl=None):
+    with self._lock:
+      self._store(key, value, ttl)
+
+  def add(self, key, value, ttl=None):
+    """Set key unless it holds a live value; returns the value now stored"""
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and (entry[1] is None or entry[1] > self.clock()):
+        return entry[0]
+      self._store(key, value, ttl)
+      return value
+
+  def _store(self, key, value, ttl):
+    ttl = self.ttl if ttl is None else ttl
+    self._entries.pop(key, None)
+    self._entries[key] = (value, None if ttl is None else self.clock() + ttl)
+    while len(self._entries) > self.max_size:
+      self._entries.popitem(last=False)
+
+  def delete(self, key):
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def __len__(self):
+    return len(self._entries)
+
+##################################################
+# RESPONSE CACHE
+##################################################
+
+class LocalBackend(object):
+  """Response cache storage inside this process"""
+
+  def __init__(self, max_size=10000):
+    self.entries = LRUCache(max_size)
+
+  def get_multi(self, keys):
+    found = {}
+    for key in keys:
+      value = self.entries.get(key)
+      if value is not None:
+        found[key] = value
+    return found
+
+  def set(self, key, value, ttl):
+    self.entries.set(key, value, ttl or None)
+
+  def add(self, key, value, ttl):
+    return self.entries.add(key, value, ttl or None)
+
+class NullBackend(object):
+  """Response cache storage that keeps nothing, so every read misses"""
+
+  def get_multi(self, keys):
+    return {}
+
+  def set(self, key, value, ttl):
+    pass
+
+  def add(self, key, value, ttl):
+    return value
+
+class SharedBackend(object):
+  """
+  Response cache storage shared by every process, through a memcached style
+  client (get_multi, set, add with a time argument). Keys are hashed so any
+  request key is a valid memcached key.
+  """
+
+  def __init__(self, client, prefix="latitune:"):
+    self.client = client
+    self.prefix = prefix
+
+  def _key(self, key):
+    return self.prefix + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+  def get_multi(self, keys):
+    hashed = dict((self._key(key), key) for key in keys)
+    found  = self.client.get_multi(hashed.keys())
+    return dict((hashed[key], value) for key, value in found.items())
+
+  def set(self, key, value, ttl):
+    self.client.set(self._key(key), value, time=ttl)
+
+  def add(self, key, value, ttl):
+    self.client.add(self._key(key), value, time=ttl)
+    return self.get_multi([key]).get(key, value)
+
+class DictClient(object):
+  """Local stand-in for a memcached client, for tests and development"""
+
+  def __init__(self, clock=time.time):
+    self.clock  = clock
+    self.values = {}
+    self._lock  = threading.Lock()
+
+  def _live(self, key):
+    value, expires = self.values.get(key, (None, None))
+    if expires and expires <= self.clock():
+      del self.values[key]
+      return None
+    return value
+
+  def get_multi(self, keys):
+    with self._lock:
+      found = [(key, self._live(key)) for key in keys]
+    return dict((key, value) for key, value in found if value is not None)
+
+  def set(self, key, value, time=0):
+    with self._lock:
+      self.values[key] = (value, self.clock() + time if time else None)
+    return True
+
+  def add(self, key, value, time=0):
+    with self._lock:
+      if self._live(key) is not None:
+        return False
+      self.values[key] = (value, self.clock() + time if time else None)
+    return True
+
+class ResponseCache(object):
+  """
+  Cached values invalidated through tags. Every tag has a version in the
+  backend; an entry records the versions of its tags when it was computed and
+  is ignored once any of them changes or disappears. Readers must take
+  versions() before reading the data the tags cover, and writers call
+  invalidate() after committing, so a racing write can only cause a miss.
+  """
+
+  def __init__(self, backend, ttl=300):
+    self.backend = backend
+    self.ttl     = ttl
+
+  def versions(self, tags):
+    """Current version of each tag, by tag"""
+    keys  = dict(('tag:' + tag, tag) for tag in tags)
+    found = self.backend.get_multi(keys.keys())
+    for key in keys:
+      if key not in found:
+        found[key] = self.backend.add(key, uuid.uuid4().hex, 0)
+    return dict((keys[key], version) for key, version in found.items())
+
+  def get(self, key):
+    entry = self.backend.get_multi(['value:' + key]).get('value:' + key)
+    if entry is None:
+      return None
+    value, versions = entry
+    current = self.backend.get_multi(['tag:' + tag for tag in versions])
+    if any([current.get('tag:' + tag) != version for tag, version in versions.items()]):
+      return None
+    return value
+
+  def set(self, key, value, versions, ttl=None):
+    """Store value, valid while versions hold, for ttl seconds (default self.ttl)"""
+    if ttl is None or (self.ttl and self.ttl < ttl):
+      ttl = self.ttl
+    self.backend.set('value:' + key, (value, versions), ttl)
+
+  def invalidate(self, *tags):
+    for tag in tags:
+      self.backend.set('tag:' + tag, uuid.uuid4().hex, 0)
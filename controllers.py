@@ -1,12 +1,33 @@
 ##################################################
 # CONTROLLERS
 ##################################################
-from flask import Flask, jsonify, request
+import json
+import time
+import hmac
+import base64
+import hashlib
+from datetime import datetime
+from flask import Flask, jsonify, request, g, abort, stream_with_context
 from sqlalchemy.exc import IntegrityError
 from settings import *
 from models import *
+from cache import LRUCache, ResponseCache, LocalBackend, NullBackend, SharedBackend, DictClient
+from resolver import song_resolver, provider_cache
+from nearby import NearbyCache, NEARBY_CANDIDATES
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+from trending import HotIndex
+from instrumentation import phase, route_metrics
+from push import LocalBroker, PostgresBroker, event_stream
+from feed import Timelines
+import search
 
 MISSING_PARAMETERS      = 10
+INVALID_CURSOR          = 11
+MALFORMED_PARAMETERS    = 12
+STREAMS_UNAVAILABLE     = 13
 SUCCESS                 = 20
 EMAIL_EXISTS            = 30
 USERNAME_EXISTS         = 31
@@ -14,11 +35,17 @@ INVALID_AUTH            = 32
 USERNAME_DOES_NOT_EXIST = 33
 SONG_DOES_NOT_EXIST     = 40
 BLIP_DOES_NOT_EXIST     = 50
+BATCH_TOO_LARGE         = 51
 COMMENT_DOES_NOT_EXIST  = 60
 FAVORITE_DOES_NOT_EXIST = 70
+GROUP_DOES_NOT_EXIST    = 80
+NOT_GROUP_MEMBER        = 81
 
 STATUS_CODE_MESSAGES = {
   MISSING_PARAMETERS      : "Missing Required Parameters",
+  INVALID_CURSOR          : "Invalid pagination cursor",
+  MALFORMED_PARAMETERS    : "Malformed Parameters",
+  STREAMS_UNAVAILABLE     : "Streams need gevent or eventlet workers",
   SUCCESS                 : "Success",
   EMAIL_EXISTS            : "Email already exists",
   USERNAME_EXISTS         : "Username already exists",
@@ -26,28 +53,228 @@ STATUS_CODE_MESSAGES = {
   USERNAME_DOES_NOT_EXIST : "Username does not exist",
   SONG_DOES_NOT_EXIST     : "Song ID does not exist",
   BLIP_DOES_NOT_EXIST     : "Blip ID does not exist",
+  BATCH_TOO_LARGE         : "Too many blips in batch",
   COMMENT_DOES_NOT_EXIST  : "Comment ID does not exist",
-  FAVORITE_DOES_NOT_EXIST : "Favorite ID does not exist"
+  FAVORITE_DOES_NOT_EXIST : "Favorite ID does not exist",
+  GROUP_DOES_NOT_EXIST    : "Group ID does not exist",
+  NOT_GROUP_MEMBER        : "User is not a member of the group"
 }
 
+# objects per chunk written by API_Response.as_stream, and rows fetched per
+# round trip by the streaming queries feeding it
+STREAM_CHUNK_SIZE = 100
+
+JSON_MIMETYPE    = 'application/json'
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+
+def response_mimetype():
+  """Format negotiated through the Accept header; MessagePack needs msgpack installed"""
+  if msgpack is None:
+    return JSON_MIMETYPE
+  return request.accept_mimetypes.best_match([JSON_MIMETYPE, MSGPACK_MIMETYPE], JSON_MIMETYPE)
+
 ##
 # Helper to build json responses for API endpoints
 ##
 class API_Response:
-  def __init__(self,status=SUCCESS, objs=[], error=""):
-   self.status = status
-   self.error  = STATUS_CODE_MESSAGES[status]
-   self.objs   = objs
+  def __init__(self,status=SUCCESS, objs=[], error="", next_cursor=None, meta=None):
+   self.status      = status
+   self.error       = STATUS_CODE_MESSAGES[status]
+   self.objs        = objs
+   self.next_cursor = next_cursor
+   self.meta        = meta or {}
 
   def as_dict(self):
+    meta = {"status":self.status}
     if self.status != SUCCESS:
-      return {"meta"    : {"status":self.status,"error":self.error},
-              "objects" : self.objs}
-    else:
-      return {"meta"    : {"status":self.status},"objects":self.objs}
+      meta["error"] = self.error
+    if self.next_cursor:
+      meta["next_cursor"] = self.next_cursor
+    meta.update(self.meta)
+    return {"meta":meta,"objects":self.objs}
 
   def as_json(self):
-    return jsonify(self.as_dict())
+    """The response as JSON, or MessagePack for clients that prefer it"""
+    g.api_status = self.status
+    mimetype = response_mimetype()
+    with phase('encode'):
+      if mimetype == MSGPACK_MIMETYPE:
+        response = app.response_class(msgpack.packb(self.as_dict()), mimetype=mimetype)
+      else:
+        response = jsonify(self.as_dict())
+    response.headers['Vary'] = 'Accept'
+    if self.status == SUCCESS:
+      add_validators(response, getattr(g, 'etag', None), getattr(g, 'last_modified', None))
+    return response
+
+  def as_stream(self):
+    """
+    Like as_json, but objs may be any iterable of serialized objects (e.g. a
+    generator over a yield_per query), encoded and sent STREAM_CHUNK_SIZE at a
+    time as they are produced. The whole payload is never held in memory.
+    """
+    meta = json.dumps(self.as_dict()["meta"])
+    objs = self.objs
+    def generate():
+      yield '{"meta": %s, "objects": [' % meta
+      chunk = []
+      first = True
+      for obj in objs:
+        chunk.append(json.dumps(obj))
+        if len(chunk) == STREAM_CHUNK_SIZE:
+          yield ('' if first else ', ') + ', '.join(chunk)
+          chunk = []
+          first = False
+      if chunk:
+        yield ('' if first else ', ') + ', '.join(chunk)
+      yield ']}'
+    response = app.response_class(stream_with_context(generate()), mimetype='application/json')
+    add_validators(response, getattr(g, 'etag', None), getattr(g, 'last_modified', None))
+    return response
+
+def wants_stream():
+  """stream=1 asks a list endpoint for every row as one streamed response"""
+  return request.args.get('stream') in ('1', 'true')
+
+DEFAULT_BLIP_LIMIT = 25
+MAX_BLIP_LIMIT     = 100
+BOUNDS_ARGUMENTS   = ['north', 'south', 'east', 'west']
+
+# gunicorn worker classes serving requests as greenlets, which an open stream
+# does not block; streams are refused under any other, or an unknown, class
+STREAM_WORKER_CLASSES = ['gevent', 'gevent_wsgi', 'gevent_pywsgi', 'eventlet']
+
+DEFAULT_PAGE_SIZE  = 100
+MAX_PAGE_SIZE      = 500
+
+def get_limit(default, maximum):
+  """Page size requested through the limit argument, clamped to [1, maximum]"""
+  try:
+    limit = int(request.args.get('limit', default))
+  except ValueError:
+    limit = default
+  return max(1, min(limit, maximum))
+
+##
+# Keyset pagination. A cursor is the sort key of the last row of the
+# previous page, so every page is one bounded index range scan.
+##
+class InvalidCursor(Exception):
+  pass
+
+def encode_cursor(values):
+  values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+  return base64.urlsafe_b64encode(json.dumps(values))
+
+def decode_cursor(cursor, columns):
+  try:
+    values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    if not isinstance(values, list) or len(values) != len(columns):
+      raise InvalidCursor(cursor)
+    return [parse_timestamp(value) if isinstance(column.property.columns[0].type, db.DateTime) else value
+            for column, value in zip(columns, values)]
+  except (TypeError, ValueError):
+    raise InvalidCursor(cursor)
+
+def parse_timestamp(value):
+  for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+    try:
+      return datetime.strptime(value, fmt)
+    except ValueError:
+      pass
+  raise ValueError(value)
+
+def paginate(query, columns, key, descending=False):
+  """
+  One page of query ordered by columns, resuming after request.args['cursor'].
+  key maps a result row to its values for columns. Returns (rows, next_cursor)
+  with next_cursor None on the last page. Raises InvalidCursor.
+  """
+  limit = get_limit(DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+  if request.args.get('cursor'):
+    values = decode_cursor(request.args['cursor'], columns)
+    after  = []
+    for i, column in enumerate(columns):
+      step = column < values[i] if descending else column > values[i]
+      after.append(db.and_(*([c == v for c, v in zip(columns[:i], values[:i])] + [step])))
+    query = query.filter(db.or_(*after))
+  query = query.order_by(*[column.desc() if descending else column.asc() for column in columns])
+  rows  = query.limit(limit + 1).all()
+  if len(rows) > limit:
+    return rows[:limit], encode_cursor(key(rows[limit - 1]))
+  return rows, None
+
+##
+# Field projections: fields=a,b,c restricts each object to those fields, and
+# handlers push the selection down into the query.
+##
+class InvalidFields(Exception):
+  pass
+
+def parse_fields(allowed):
+  """Fields requested through the fields argument, None for all. Raises InvalidFields."""
+  if not request.args.get('fields'):
+    return None
+  fields = []
+  for field in request.args['fields'].split(','):
+    if field not in allowed:
+      raise InvalidFields(field)
+    if field not in fields:
+      fields.append(field)
+  return fields
+
+##
+# Conditional GETs. Before loading anything, handlers pass not_modified() the
+# newest modification time of everything the response covers, plus anything
+# else that identifies its contents. That becomes the response's ETag and
+# Last-Modified, and a client already holding it gets a bodiless 304.
+##
+def http_date(value):
+  """A local naive datetime as the naive UTC datetime HTTP headers carry"""
+  return datetime.utcfromtimestamp(time.mktime(value.timetuple()))
+
+def add_validators(response, etag, last_modified):
+  if etag:
+    response.set_etag(etag)
+  if last_modified:
+    response.last_modified = last_modified
+
+def client_is_current(etag, last_modified):
+  if request.if_none_match:
+    return bool(etag) and request.if_none_match.contains(etag)
+  if request.if_modified_since and last_modified:
+    return last_modified <= request.if_modified_since
+  return False
+
+def not_modified(modified, *validators):
+  """Record the response's validators; True when the client's copy is current"""
+  args = sorted(request.args.items(multi=True))
+  g.etag = hashlib.sha1(repr((response_mimetype(), request.path, args, modified, validators))).hexdigest()
+  g.last_modified = http_date(modified) if modified else None
+  return client_is_current(g.etag, g.last_modified)
+
+def not_modified_response(etag, last_modified):
+  response = app.response_class(status=304)
+  add_validators(response, etag, last_modified)
+  return response
+
+##
+# Read-your-writes: for DATABASE_REPLICA_LAG seconds after a write, a client
+# carries PRIMARY_COOKIE and its reads skip the replicas and the shared
+# caches, which replica reads may have refilled since its write invalidated
+# them.
+##
+PRIMARY_COOKIE = 'latitune_primary'
+
+def reads_primary():
+  """Whether the client wrote within DATABASE_REPLICA_LAG"""
+  return PRIMARY_COOKIE in request.cookies
+
+@app.after_request
+def stick_to_primary(response):
+  if request.method != 'GET' and app.config['DATABASE_REPLICAS']:
+    response.set_cookie(PRIMARY_COOKIE, '1', max_age=app.config['DATABASE_REPLICA_LAG'])
+  return response
 
 # Decorator declarations
 
@@ -64,6 +291,50 @@ def check_arguments(names):
     return wrapped_fn
   return wrap
 
+def read_only(fn):
+  """
+  For handlers that only read. They read from a replica unless the client
+  wrote recently. Their transaction is never committed; it is closed, handing
+  the connection back to the pool, as soon as the response is built (or, for
+  streamed responses, at teardown once the stream is written).
+  """
+  @functools.wraps(fn)
+  def wrapped_fn():
+    if not reads_primary():
+      db.session().use_replica()
+    response = fn()
+    if not response.is_streamed:
+      db.session.close()
+    return response
+  return wrapped_fn
+
+##
+# Verified credentials, so the deliberately slow password hash runs once per
+# AUTH_CACHE_TTL rather than on every authenticated request. Entries are keyed
+# by user id and hold an HMAC of the stored hash and the password under a
+# per-process secret; changing the password changes the stored hash and so
+# invalidates the entry.
+##
+AUTH_CACHE_SIZE   = 10000
+AUTH_CACHE_TTL    = 300
+AUTH_CACHE_SECRET = os.urandom(32)
+
+credential_cache = LRUCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+def credential_digest(user, password):
+  message = (user.pw_hash + u'\0' + password).encode('utf-8')
+  return hmac.new(AUTH_CACHE_SECRET, message, hashlib.sha256).digest()
+
+def check_credentials(user, password):
+  digest = credential_digest(user, password)
+  cached = credential_cache.get(user.id)
+  if cached is not None and hmac.compare_digest(cached, digest):
+    return True
+  if not user.check_password(password):
+    return False
+  credential_cache.set(user.id, digest)
+  return True
+
 def require_authentication(fn):
   @functools.wraps(fn)
   def wrap():
@@ -72,17 +343,100 @@ def require_authentication(fn):
     if u_field and not all ([arg in request.values for arg in [u_field, 'password']]):
       return API_Response(MISSING_PARAMETERS).as_json()
     else:
-      if u_field == 'user_id':
-        user = User.query.filter_by(id=request.values[u_field]).first()
-      elif u_field == 'username':
-        user = User.query.filter_by(name=request.values[u_field]).first()
-        if not user:
-          return API_Response(USERNAME_DOES_NOT_EXIST).as_json()
-      if not user or not user.check_password(request.values['password']):
-        return API_Response(INVALID_AUTH).as_json()
+      with phase('auth'):
+        if u_field == 'user_id':
+          user = User.query.filter_by(id=request.values[u_field]).first()
+        elif u_field == 'username':
+          user = User.query.filter_by(name=request.values[u_field]).first()
+          if not user:
+            return API_Response(USERNAME_DOES_NOT_EXIST).as_json()
+        if not user or not check_credentials(user, request.values['password']):
+          return API_Response(INVALID_AUTH).as_json()
       return fn()
   return wrap
 
+##
+# Cache for read endpoints. Handlers call cache_tags() for everything a
+# response depends on *before* reading it; write paths invalidate those tags
+# after committing. Successful tagged responses are stored.
+##
+def make_response_cache():
+  if app.config['MEMCACHED_SERVERS']:
+    import memcache
+    backend = SharedBackend(memcache.Client(app.config['MEMCACHED_SERVERS'].split(',')))
+  elif app.config['WORKER_PROCESSES'] > 1:
+    # other processes would keep serving what this one invalidates
+    print >> sys.stderr, ('%d worker processes and no MEMCACHED_SERVERS: response caching is off'
+                          % app.config['WORKER_PROCESSES'])
+    backend = NullBackend()
+  else:
+    backend = LocalBackend(app.config['RESPONSE_CACHE_SIZE'])
+  return ResponseCache(backend, app.config['RESPONSE_CACHE_TTL'])
+
+def make_push_broker():
+  if db.engine.name == 'postgresql':
+    return PostgresBroker(db.engine, app.config['PUSH_BUFFER'])
+  if app.config['WORKER_PROCESSES'] > 1:
+    print >> sys.stderr, ('%d worker processes and no Postgres to relay events: streams only get '
+                          'events written by their own worker' % app.config['WORKER_PROCESSES'])
+  return LocalBroker(app.config['PUSH_BUFFER'])
+
+response_cache = make_response_cache()
+# without anywhere to keep them, nearby candidates are not worth computing
+nearby_cache   = NearbyCache(response_cache,
+                             0 if isinstance(response_cache.backend, NullBackend) else NEARBY_CANDIDATES)
+hot_index      = HotIndex()
+push_broker    = make_push_broker()
+timelines      = Timelines()
+
+def cache_tags(*tags):
+  g.cache_versions.update(response_cache.versions(tags))
+
+def id_tag(kind, value):
+  return '%s:%d' % (kind, int(value))
+
+def search_tag(kind):
+  return 'search:' + kind
+
+def cached_response(fn):
+  @functools.wraps(fn)
+  def wrapped_fn():
+    if reads_primary():
+      g.cache_versions = {}
+      return fn()
+    mimetype = response_mimetype()
+    key      = mimetype + ' ' + request.path + '?' + repr(sorted(request.args.items(multi=True)))
+    with phase('cache'):
+      cached = response_cache.get(key)
+    if cached is not None:
+      data, etag, last_modified = cached
+      if client_is_current(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+      response = app.response_class(data, mimetype=mimetype)
+      response.headers['Vary'] = 'Accept'
+      add_validators(response, etag, last_modified)
+      return response
+    g.cache_versions = {}
+    g.api_status     = None
+    response = fn()
+    if g.api_status == SUCCESS and g.cache_versions and not response.is_streamed:
+      with phase('cache'):
+        response_cache.set(key, (response.data, response.get_etag()[0], response.last_modified),
+                           g.cache_versions, db.session().cache_ttl())
+    return response
+  return wrapped_fn
+
+def invalidate_song(song_id):
+  """Drop cached responses embedding a song whose provider id just changed"""
+  blip_ids = db.session.query(Blip.id).filter_by(song_id=song_id)
+  response_cache.invalidate(id_tag('song', song_id), *[id_tag('blip', blip_id) for blip_id, in blip_ids])
+
+song_resolver.listeners.append(invalidate_song)
+
+@app.before_first_request
+def requeue_pending_songs():
+  song_resolver.requeue_pending()
+
 # DEVELOPMENT ONLY
 
 @app.route("/api/tabularasa", methods=['GET'])
@@ -94,6 +448,15 @@ def destroy():
     return "OK"
   return "WHO DO YOU THINK YOU ARE?"
 
+# METRICS
+
+@app.route("/api/metrics", methods=['GET'])
+def get_metrics():
+  """Latency histograms and phase totals per route, for this worker only"""
+  if not app.config['METRICS_ENDPOINT']:
+    abort(404)
+  return API_Response(SUCCESS, route_metrics.snapshot()).as_json()
+
 # USER
 
 @app.route("/api/user", methods=['PUT'])
@@ -104,7 +467,10 @@ def create_user():
                     request.form['email'],
                     request.form['password'])
     db.session.add(new_user)
+    db.session.flush()
+    search.index('user', new_user)
     db.session.commit()
+    response_cache.invalidate(search_tag('user'))
     return API_Response(SUCCESS, [new_user.serialize]).as_json()
   except IntegrityError as e:
     db.session.rollback()
@@ -114,6 +480,7 @@ def create_user():
       return API_Response(USERNAME_EXISTS).as_json()
 
 @app.route("/api/user", methods=['GET'])
+@read_only
 @require_authentication
 def get_user_id():
   try:
@@ -125,32 +492,96 @@ def get_user_id():
 # BLIPS
 
 @app.route("/api/blip", methods=['GET'])
+@read_only
+@cached_response
 def get_blip():
   try:
+    limit  = get_limit(DEFAULT_BLIP_LIMIT, MAX_BLIP_LIMIT)
+    fields = parse_fields(Blip.FIELDS)
+    query  = Blip.select(fields)
+    render = lambda blip: Blip.render(blip, fields)
     if all([arg in request.args for arg in ['latitude','longitude']]):
-      lat = request.args['latitude']
-      lng = request.args['longitude']
-      db.session.commit()
-      query = """
-        SELECT id, longitude, latitude,
-          (3959*ACOS(COS(RADIANS(%(lat)i))*COS(RADIANS(latitude))*COS(RADIANS(longitude)-RADIANS(%(lng)i))+SIN(RADIANS(%(lat)i))*SIN(RADIANS(latitude))))
-        AS distance from blip
-        order by distance asc limit 25""" % {'lat': float(lat), 'lng': float(lng)}
-      blips = Blip.query.from_statement(query).all()
-      return API_Response(SUCCESS,[blip.serialize for blip in blips]).as_json()
+      lat = float(request.args['latitude'])
+      lng = float(request.args['longitude'])
+      radius = float(request.args['radius']) if 'radius' in request.args else None
+      if radius is not None and not radius <= app.config['MAX_RADIUS']:
+        return API_Response(MALFORMED_PARAMETERS).as_json()
+      if request.args.get('sort') == 'hot':
+        blip_ids = hot_index.feed(lat, lng, limit)
+      elif radius is None and reads_primary():
+        blip_ids = Blip.nearest_ids(lat, lng, limit)
+      elif radius is None:
+        blip_ids = nearby_cache.nearest_ids(lat, lng, limit)
+      else:
+        blip_ids = [b_id for distance, b_id in Blip.within_radius(lat, lng, radius)[:limit]]
+      newest, modified = Blip.version(blip_ids)
+      if not_modified(modified, blip_ids):
+        return not_modified_response(g.etag, g.last_modified)
+      blips = Blip.by_ids(blip_ids, query)
+      return API_Response(SUCCESS,[render(blip) for blip in blips]).as_json()
+    elif any([arg in request.args for arg in BOUNDS_ARGUMENTS]):
+      if not all([arg in request.args for arg in BOUNDS_ARGUMENTS]):
+        return API_Response(MISSING_PARAMETERS).as_json()
+      north, south, east, west = [float(request.args[arg]) for arg in BOUNDS_ARGUMENTS]
+      newest, modified = Blip.in_bounds(Blip.version_query(), north, south, east, west).one()
+      if not_modified(modified, newest):
+        return not_modified_response(g.etag, g.last_modified)
+      blips = Blip.within_bounds(north, south, east, west, limit, query)
+      return API_Response(SUCCESS,[render(blip) for blip in blips]).as_json()
     elif 'id' in request.args:
       blip_id = request.args['id']
-      blip = Blip.query.filter_by(id=blip_id).first()
+      cache_tags(id_tag('blip', blip_id))
+      newest, modified = Blip.version([blip_id])
+      if modified and not_modified(modified):
+        return not_modified_response(g.etag, g.last_modified)
+      blip = query.filter(Blip.id == blip_id).first()
       if blip:
-        return API_Response(SUCCESS, [blip.serialize]).as_json()
+        return API_Response(SUCCESS, [render(blip)]).as_json()
       else:
         return API_Response("ERR", []).as_json()
     else:
-      blips = Blip.query.all()
-      return API_Response(SUCCESS,[blip.serialize for blip in blips]).as_json()
+      newest, modified = Blip.version()
+      if not_modified(modified, newest):
+        return not_modified_response(g.etag, g.last_modified)
+      if wants_stream():
+        blips = query.order_by(Blip.id).yield_per(STREAM_CHUNK_SIZE)
+        return API_Response(SUCCESS, (render(blip) for blip in blips)).as_stream()
+      blips, next_cursor = paginate(query, [Blip.id], lambda blip: [blip.id])
+      return API_Response(SUCCESS,[render(blip) for blip in blips],next_cursor=next_cursor).as_json()
+  except InvalidCursor:
+    return API_Response(INVALID_CURSOR).as_json()
+  except (InvalidFields, ValueError):
+    return API_Response(MALFORMED_PARAMETERS).as_json()
   except Exception as e:
     return API_Response("ERR", [], str(e)).as_json()
 
+@app.route("/api/blip/stream", methods=['GET'])
+def stream_blips():
+  """
+  Server-sent events for every blip, comment and favorite created inside a
+  region, given as north/south/east/west or as latitude/longitude/radius.
+  Each event's data is the object as the PUT that created it returned it.
+  """
+  if app.config['WORKER_CLASS'] not in STREAM_WORKER_CLASSES:
+    # the stream would hold the worker until gunicorn's timeout killed it
+    response = API_Response(STREAMS_UNAVAILABLE).as_json()
+    response.status_code = 503
+    return response
+  try:
+    if all([arg in request.args for arg in BOUNDS_ARGUMENTS]):
+      north, south, east, west = [float(request.args[arg]) for arg in BOUNDS_ARGUMENTS]
+    elif all([arg in request.args for arg in ['latitude','longitude','radius']]):
+      north, south, east, west = geo.bounding_box(float(request.args['latitude']),
+                                                  float(request.args['longitude']),
+                                                  float(request.args['radius']))
+    else:
+      return API_Response(MISSING_PARAMETERS).as_json()
+  except ValueError:
+    return API_Response(MALFORMED_PARAMETERS).as_json()
+  subscription = push_broker.subscribe(north, south, east, west)
+  stream = event_stream(push_broker, subscription, app.config['PUSH_HEARTBEAT'], app.config['PUSH_RETRY'])
+  return app.response_class(stream, mimetype='text/event-stream', headers={'Cache-Control':'no-cache'})
+
 @app.route("/api/blip", methods=['PUT'])
 @check_arguments(['song_id','longitude', 'latitude','user_id','password'])
 @require_authentication
@@ -167,24 +598,105 @@ def create_blip():
 
     db.session.add(new_blip)
     db.session.commit()
-    return API_Response(SUCCESS, [new_blip.serialize]).as_json()
+    nearby_cache.invalidate((new_blip.latitude, new_blip.longitude))
+    hot_index.update(new_blip.geohash, new_blip.id, new_blip.hot_score)
+    serialized = new_blip.serialize
+    push_broker.publish('blip', new_blip.latitude, new_blip.longitude, serialized)
+    return API_Response(SUCCESS, [serialized]).as_json()
   except Exception as e:
     return API_Response("ERR", [], str(e)).as_json()
   return None
 
+MAX_BLIP_BATCH = 500
+
+def item_status(status):
+  """Per-item status of a batch request, shaped like a response's meta"""
+  if status == SUCCESS:
+    return {"status":status}
+  return {"status":status,"error":STATUS_CODE_MESSAGES[status]}
+
+def parse_batch_blip(item):
+  """Column values for one item of a blip batch, or the status code rejecting it"""
+  if not isinstance(item, dict) or not all([arg in item for arg in ['song_id','latitude','longitude']]):
+    return MISSING_PARAMETERS
+  try:
+    song_id = int(item['song_id'])
+    lat     = float(item['latitude'])
+    lng     = float(item['longitude'])
+  except (TypeError, ValueError):
+    return MALFORMED_PARAMETERS
+  if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+    return MALFORMED_PARAMETERS
+  return {'song_id':song_id, 'latitude':lat, 'longitude':lng}
+
+@app.route("/api/blip/batch", methods=['PUT'])
+@check_arguments(['blips','user_id','password'])
+@require_authentication
+def create_blips():
+  """
+  Create every blip in the JSON array blips ([{song_id, latitude, longitude}])
+  for the authenticated user with one song lookup and one multi-row insert.
+  objects holds a status for each item, in order.
+  """
+  try:
+    items = json.loads(request.form['blips'])
+  except ValueError:
+    return API_Response(MALFORMED_PARAMETERS).as_json()
+  if not isinstance(items, list):
+    return API_Response(MALFORMED_PARAMETERS).as_json()
+  if len(items) > MAX_BLIP_BATCH:
+    return API_Response(BATCH_TOO_LARGE).as_json()
+
+  parsed = [parse_batch_blip(item) for item in items]
+  song_ids = set(row['song_id'] for row in parsed if isinstance(row, dict))
+  if song_ids:
+    song_ids = set(song_id for song_id, in db.session.query(Song.id).filter(Song.id.in_(list(song_ids))))
+  now      = datetime.now()
+  rows     = []
+  statuses = []
+  for row in parsed:
+    if isinstance(row, dict) and row['song_id'] not in song_ids:
+      row = SONG_DOES_NOT_EXIST
+    if not isinstance(row, dict):
+      statuses.append(item_status(row))
+      continue
+    row.update({'user_id'   : int(request.form['user_id']),
+                'geohash'   : geo.encode(row['latitude'], row['longitude']),
+                'timestamp' : now,
+                'hot_score' : scoring.initial_score(now)})
+    rows.append(row)
+    statuses.append(item_status(SUCCESS))
+
+  if rows:
+    db.session.execute(Blip.__table__.insert(), rows)
+    db.session.commit()
+    nearby_cache.invalidate(*[(row['latitude'], row['longitude']) for row in rows])
+    hot_index.invalidate(*[row['geohash'] for row in rows])
+    if push_broker.has_subscribers():
+      for blip in Blip.eager().filter_by(user_id=int(request.form['user_id']), timestamp=now):
+        push_broker.publish('blip', blip.latitude, blip.longitude, blip.serialize)
+  return API_Response(SUCCESS, statuses).as_json()
+
 # SONG
 
 @app.route("/api/song",methods=['PUT'])
 @check_arguments(['artist','title'])
 def create_song():
   try:
-    new_song = Song.query.filter_by(artist=request.form['artist'],
-                                    title=request.form['title']).first()
-    if not new_song:
-      new_song = Song(request.form['artist'], request.form['title'])
-      db.session.add(new_song)
-      db.session.commit()
-    return API_Response(SUCCESS, [new_song.serialize]).as_json()
+    new_song = Song(request.form['artist'], request.form['title'], resolve=False)
+    provider_song_id = provider_cache.get(new_song.provider_key, new_song.artist, new_song.title)
+    if provider_song_id is not None:
+      new_song.resolved(provider_song_id)
+    song, created = Song.upsert(new_song)
+    if created:
+      search.index('song', song)
+    db.session.commit()
+    if created:
+      response_cache.invalidate(search_tag('song'))
+    response = API_Response(SUCCESS, [song.serialize]).as_json()
+    if created and song.provider_state == PROVIDER_PENDING:
+      song_resolver.submit(song.id)
+    return response
   except Exception as e:
     return API_Response("ERR", [], request.form).as_json()
   return None
@@ -199,19 +711,54 @@ def create_comment():
     return API_Response(BLIP_DOES_NOT_EXIST).as_json()
   new_comment = Comment(request.form['user_id'],request.form['blip_id'],request.form['comment'])
   db.session.add(new_comment)
+  Blip.increment(blip.id, 'comment_count')
+  hot = Blip.record_event(blip.id, scoring.COMMENT_WEIGHT)
+  db.session.flush()
+  search.index('comment', new_comment)
   db.session.commit()
-  return API_Response(SUCCESS,[new_comment.serialize]).as_json()
+  hot_index.update(*hot)
+  response_cache.invalidate(id_tag('comments', blip.id), id_tag('blip', blip.id), search_tag('comment'))
+  serialized = new_comment.serialize
+  push_broker.publish('comment', serialized['blip']['latitude'], serialized['blip']['longitude'], serialized)
+  return API_Response(SUCCESS,[serialized]).as_json()
 
 @app.route("/api/blip/comment",methods=['GET'])
+@read_only
+@cached_response
 def get_comment():
   if 'id' in request.args:
-    comment = Comment.query.filter_by(id=request.args['id']).first()
-    if not comment:
+    found = (db.session.query(Comment.blip_id, Blip.modified)
+                       .filter(Comment.blip_id == Blip.id)
+                       .filter(Comment.id == request.args['id']).first())
+    if found is None:
       return API_Response(COMMENT_DOES_NOT_EXIST).as_json()
+    blip_id, modified = found
+    cache_tags(id_tag('blip', blip_id))
+    if not_modified(modified):
+      return not_modified_response(g.etag, g.last_modified)
+    comment = Comment.eager().filter_by(id=request.args['id']).first()
     return API_Response(SUCCESS,[comment.serialize]).as_json()
   if 'blip_id' in request.args:
-    comments = Comment.query.filter_by(blip_id=request.args['blip_id']).order_by(db.desc('comment.timestamp')).all()
-    return API_Response(SUCCESS,[comment.serialize for comment in comments]).as_json()
+    try:
+      cache_tags(id_tag('comments', request.args['blip_id']), id_tag('blip', request.args['blip_id']))
+      # adding a comment updates its blip's comment_count, and so its modified time
+      newest, modified = Blip.version([request.args['blip_id']])
+      if modified and not_modified(modified):
+        return not_modified_response(g.etag, g.last_modified)
+      if wants_stream():
+        comments = (Comment.eager().filter_by(blip_id=request.args['blip_id'])
+                                   .order_by(Comment.timestamp.desc(), Comment.id.desc())
+                                   .yield_per(STREAM_CHUNK_SIZE))
+        return API_Response(SUCCESS, (comment.serialize for comment in comments)).as_stream()
+      comments, next_cursor = paginate(Comment.eager().filter_by(blip_id=request.args['blip_id']),
+                                       [Comment.timestamp, Comment.id],
+                                       lambda comment: [comment.timestamp, comment.id],
+                                       descending=True)
+    except InvalidCursor:
+      return API_Response(INVALID_CURSOR).as_json()
+    except ValueError:
+      return API_Response(MALFORMED_PARAMETERS).as_json()
+    return API_Response(SUCCESS,[comment.serialize for comment in comments],next_cursor=next_cursor).as_json()
   return API_Response(MISSING_PARAMETERS).as_json()
 
 @app.route("/api/blip/favorite",methods=['PUT'])
@@ -226,19 +773,47 @@ def create_favorite():
   if not existing:
     new_favorite = Favorite(request.form['user_id'],request.form['blip_id'])
     db.session.add(new_favorite)
+    Blip.increment(blip.id, 'favorite_count')
+    hot = Blip.record_event(blip.id, scoring.FAVORITE_WEIGHT)
+    location = (blip.latitude, blip.longitude)
     db.session.commit()
+    hot_index.update(*hot)
+    response_cache.invalidate(id_tag('favorites:user', new_favorite.user_id),
+                              id_tag('favorites:blip', new_favorite.blip_id),
+                              id_tag('blip', new_favorite.blip_id))
+    push_broker.publish('favorite', location[0], location[1], new_favorite.serialize)
     existing = new_favorite
   return API_Response(SUCCESS,[existing.serialize]).as_json()
 
 @app.route("/api/blip/favorite",methods=["GET"])
+@read_only
+@cached_response
 def get_favorites():
-  if "blip_id" in request.args:
-    favorites = Favorite.query.filter_by(blip_id=request.args['blip_id']).order_by(db.desc("user_id")).all()
-    objects = map(lambda x:User.query.get(x.user_id),favorites)
-  if "user_id" in request.args:
-    favorites = Favorite.query.filter_by(user_id=request.args['user_id']).order_by(db.asc("blip_id")).all()
-    objects = map(lambda x:Blip.query.get(x.blip_id),favorites)
-  return API_Response(SUCCESS,[] if objects == [] else [object.serialize for object in objects]).as_json()
+  try:
+    if "user_id" in request.args:
+      cache_tags(id_tag('favorites:user', request.args['user_id']))
+      favorites, next_cursor = paginate(db.session.query(Favorite.blip_id, Favorite.id)
+                                                  .filter_by(user_id=request.args['user_id']),
+                                        [Favorite.blip_id, Favorite.id],
+                                        lambda favorite: [favorite.blip_id, favorite.id])
+      blip_ids = [favorite.blip_id for favorite in favorites]
+      cache_tags(*[id_tag('blip', blip_id) for blip_id in blip_ids])
+      objects = Blip.by_ids(blip_ids)
+    elif "blip_id" in request.args:
+      cache_tags(id_tag('favorites:blip', request.args['blip_id']))
+      favorites, next_cursor = paginate(Favorite.query.options(db.joinedload('user'))
+                                                        .filter_by(blip_id=request.args['blip_id']),
+                                        [Favorite.user_id, Favorite.id],
+                                        lambda favorite: [favorite.user_id, favorite.id],
+                                        descending=True)
+      objects = [favorite.user for favorite in favorites]
+    else:
+      return API_Response(MISSING_PARAMETERS).as_json()
+  except InvalidCursor:
+    return API_Response(INVALID_CURSOR).as_json()
+  except ValueError:
+    return API_Response(MALFORMED_PARAMETERS).as_json()
+  return API_Response(SUCCESS,[object.serialize for object in objects],next_cursor=next_cursor).as_json()
 
 @app.route("/api/blip/favorite",methods=["DELETE"])
 @check_arguments(['user_id','blip_id','password'])
@@ -246,9 +821,142 @@ def get_favorites():
 def delete_favorite():
   favorite = Favorite.query.filter_by(blip_id=request.args['blip_id'],user_id=request.args['user_id'])
   user = User.query.get(request.args['user_id'])
-  if favorite.first() is None:
+  existing = favorite.first()
+  if existing is None:
     return API_Response(FAVORITE_DOES_NOT_EXIST).as_json()
-  favorite.delete()
+  deleted = favorite.delete()
+  Blip.increment(request.args['blip_id'], 'favorite_count', -deleted)
+  hot = Blip.record_event(request.args['blip_id'], scoring.FAVORITE_WEIGHT,
+                          existing.timestamp, withdraw=True)
   db.session.commit()
+  hot_index.update(*hot)
+  response_cache.invalidate(id_tag('favorites:user', request.args['user_id']),
+                            id_tag('favorites:blip', request.args['blip_id']),
+                            id_tag('blip', request.args['blip_id']))
   return API_Response(SUCCESS).as_json()
 
+# SEARCH
+
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT     = 50
+
+@app.route("/api/search", methods=['GET'])
+@check_arguments(['q'])
+@read_only
+@cached_response
+def search_text():
+  """
+  Songs, users and comments (or the comma separated kinds) matching every
+  word of q, the last one as a prefix, best match first.
+  """
+  kinds = request.args.get('kinds', ','.join(sorted(search.SEARCH_FIELDS))).split(',')
+  if not all([kind in search.SEARCH_FIELDS for kind in kinds]):
+    return API_Response(MALFORMED_PARAMETERS).as_json()
+  cache_tags(*[search_tag(kind) for kind in kinds])
+  hits    = search.search(request.args['q'], kinds, get_limit(DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT))
+  results = search.load(hits)
+  # results embed songs and blips, which change without touching the index
+  cache_tags(*[id_tag('song', result['song']['id']) for result in results if result['kind'] == 'song'] +
+              [id_tag('blip', result['comment']['blip']['id']) for result in results if result['kind'] == 'comment'])
+  return API_Response(SUCCESS, results).as_json()
+
+# GROUPS AND POSTS
+
+@app.route("/api/group", methods=['PUT'])
+@check_arguments(['user_id','password'])
+@require_authentication
+def create_group():
+  user  = User.query.get(request.form['user_id'])
+  group = Group([user], [])
+  db.session.add(group)
+  db.session.commit()
+  return API_Response(SUCCESS, [group.serialize]).as_json()
+
+@app.route("/api/group/member", methods=['PUT'])
+@check_arguments(['user_id','group_id','password'])
+@require_authentication
+def join_group():
+  user  = User.query.get(request.form['user_id'])
+  group = Group.query.get(request.form['group_id'])
+  if not group:
+    return API_Response(GROUP_DOES_NOT_EXIST).as_json()
+  if not Group.is_member(group.id, user.id):
+    timelines.join(group, user)
+    db.session.commit()
+  return API_Response(SUCCESS).as_json()
+
+@app.route("/api/post", methods=['PUT'])
+@check_arguments(['user_id','group_id','password','kind','url'])
+@require_authentication
+def create_post():
+  user  = User.query.get(request.form['user_id'])
+  group = Group.query.get(request.form['group_id'])
+  if not group:
+    return API_Response(GROUP_DOES_NOT_EXIST).as_json()
+  if not Group.is_member(group.id, user.id):
+    return API_Response(NOT_GROUP_MEMBER).as_json()
+  names = parse_tags(request.form.get('tags', ''))
+  tags  = Tag.query.filter(Tag.name.in_(names)).all() if names else []
+  tags += [Tag(name=name) for name in names - set(tag.name for tag in tags)]
+  post  = Post(request.form['kind'], request.form['url'], group, user, tags)
+  db.session.add(post)
+  db.session.flush()
+  timelines.publish(post)
+  db.session.commit()
+  response_cache.invalidate(*[tag_cache_tag(name) for name in names])
+  return API_Response(SUCCESS, [post.serialize]).as_json()
+
+def parse_tags(value):
+  return set(name.strip() for name in value.split(',') if name.strip())
+
+def tag_cache_tag(name):
+  return u'tag:' + name
+
+@app.route("/api/post", methods=['GET'])
+@check_arguments(['tags'])
+@read_only
+@cached_response
+def search_posts():
+  """
+  Posts with all of the comma separated tags, or any of them with match=any,
+  newest first. meta holds the number of matching posts and the number of
+  posts of each tag.
+  """
+  names     = parse_tags(request.args['tags'])
+  match_all = request.args.get('match', 'all') != 'any'
+  cache_tags(*[tag_cache_tag(name) for name in names])
+  postings  = Tag.postings(names)
+  counts    = dict((name, 0) for name in names)
+  counts.update((name, count) for t_id, name, count in postings)
+  meta      = {'total':0, 'counts':counts}
+  if not postings or (match_all and len(postings) < len(names)):
+    return API_Response(SUCCESS, [], meta=meta).as_json()
+  try:
+    query, meta['total'] = Post.tagged([t_id for t_id, name, count in postings], match_all)
+    posts, next_cursor   = paginate(query, [Post.timestamp, Post.id],
+                                    lambda post: [post.timestamp, post.id], descending=True)
+  except InvalidCursor:
+    return API_Response(INVALID_CURSOR).as_json()
+  objects = [post.serialize for post in Post.by_ids([post.id for post in posts])]
+  return API_Response(SUCCESS, objects, next_cursor=next_cursor, meta=meta).as_json()
+
+DEFAULT_FEED_LIMIT = 25
+MAX_FEED_LIMIT     = 100
+
+@app.route("/api/feed", methods=['GET'])
+@check_arguments(['user_id','password'])
+@read_only
+@require_authentication
+def get_feed():
+  """Newest posts of the user's groups, a page at a time"""
+  try:
+    limit = get_limit(DEFAULT_FEED_LIMIT, MAX_FEED_LIMIT)
+    after = None
+    if request.args.get('cursor'):
+      after = decode_cursor(request.args['cursor'], [Post.timestamp, Post.id])
+    post_ids, last = timelines.page(request.args['user_id'], after, limit)
+  except InvalidCursor:
+    return API_Response(INVALID_CURSOR).as_json()
+  next_cursor = encode_cursor(last) if last else None
+  return API_Response(SUCCESS, [post.serialize for post in Post.by_ids(post_ids)],
+                      next_cursor=next_cursor).as_json()
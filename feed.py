@@ -0,0 +1,99 @@
+##################################################
+# PRECOMPUTED FEEDS
+##################################################
+
+import random
+from models import *
+from cache import LRUCache
+
+# groups with more members than this stop fanning posts out on write; their
+# posts are merged into their members' feeds when read
+FANOUT_LIMIT       = 1000
+# timelines keep about this many of their newest entries
+TIMELINE_LENGTH    = 1000
+# a fan-out trims the timelines of this fraction of its recipients, so a
+# timeline grows to about TIMELINE_LENGTH + 1 / TIMELINE_TRIM_RATE entries
+TIMELINE_TRIM_RATE = 0.02
+# the groups a user reads posts from, beyond their timeline
+PULLED_GROUPS_SIZE = 10000
+PULLED_GROUPS_TTL  = 60
+
+def older_than(query, timestamp, id, after):
+  """Filter query to rows sorting after the (timestamp, id) key, newest first"""
+  if after is not None:
+    query = query.filter(db.or_(timestamp < after[0],
+                                db.and_(timestamp == after[0], id < after[1])))
+  return query.order_by(timestamp.desc(), id.desc())
+
+class Timelines(object):
+  """
+  Per-user feeds of the posts of their groups. Posts are copied into every
+  member's timeline when written (fan-out on write), so reading a page is one
+  range read of TimelineEntry. Groups past fanout_limit members would make
+  every post cost that many rows; their posts are read from Post instead and
+  merged in (fan-out on read).
+  """
+
+  def __init__(self, fanout_limit=FANOUT_LIMIT, length=TIMELINE_LENGTH, trim_rate=TIMELINE_TRIM_RATE):
+    self.fanout_limit = fanout_limit
+    self.length       = length
+    self.trim_rate    = trim_rate
+    self.pulled       = LRUCache(PULLED_GROUPS_SIZE, PULLED_GROUPS_TTL)
+
+  def publish(self, post):
+    """Fan a new post out to the members of its group; call before committing"""
+    if not post.group.fanout:
+      return
+    member_ids = Group.member_ids(post.group.id)
+    TimelineEntry.fan_out(post, member_ids)
+    for u_id in member_ids:
+      if random.random() < self.trim_rate:
+        TimelineEntry.trim(u_id, self.length)
+
+  def join(self, group, user):
+    """
+    Add a user to a group, backfilling their timeline with the group's recent
+    posts, or switching the group to fan-out on read once it is too large.
+    Call before committing.
+    """
+    group.users.append(user)
+    db.session.flush()
+    self.pulled.delete(user.id)
+    if group.fanout and Group.member_count(group.id) > self.fanout_limit:
+      # other members pick the switch up as their pulled groups expire
+      group.fanout = False
+      return
+    if group.fanout:
+      recent = Post.in_groups([group.id]).order_by(Post.timestamp.desc()).limit(self.length)
+      rows   = [{'user_id':user.id, 'post_id':p_id, 'timestamp':timestamp} for timestamp, p_id in recent]
+      if rows:
+        db.session.execute(TimelineEntry.__table__.insert(), rows)
+
+  def pulled_groups(self, user_id):
+    group_ids = self.pulled.get(user_id)
+    if group_ids is None:
+      group_ids = Group.pulled_ids(user_id)
+      self.pulled.set(user_id, group_ids)
+    return group_ids
+
+  def page(self, user_id, after, limit):
+    """
+    Ids of the limit newest posts of a user's feed sorting after the
+    (timestamp, post id) key after (None for the first page), and the key of
+    the last one if there are more.
+    """
+    rows = older_than(db.session.query(TimelineEntry.timestamp, TimelineEntry.post_id)
+                                .filter(TimelineEntry.user_id == user_id),
+                      TimelineEntry.timestamp, TimelineEntry.post_id, after).limit(limit + 1).all()
+    group_ids = self.pulled_groups(user_id)
+    if group_ids:
+      # a group switched to fan-out on read still has its older posts in timelines
+      pulled = older_than(Post.in_groups(group_ids), Post.timestamp, Post.id, after).limit(limit + 1)
+      rows   = sorted(set(tuple(row) for row in rows + pulled.all()), reverse=True)
+    keys = [tuple(row) for row in rows]
+    if len(keys) > limit:
+      return [p_id for timestamp, p_id in keys[:limit]], keys[limit - 1]
+    return [p_id for timestamp, p_id in keys], None
+
+  def clear(self):
+    self.pulled.clear()
@@ -0,0 +1,156 @@
+##################################################
+# GEO HELPERS
+##################################################
+
+import math
+
+EARTH_RADIUS_MILES = 3959
+
+GEOHASH_ALPHABET  = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 12
+
+# the most geohash prefixes a single bounding box query may be split into
+MAX_COVER_CELLS = 16
+
+# nearest neighbour searches start at this radius (miles) and grow by
+# SEARCH_RADIUS_GROWTH until they hold enough blips
+INITIAL_SEARCH_RADIUS = 1.0
+SEARCH_RADIUS_GROWTH  = 4
+MAX_SEARCH_RADIUS     = math.pi * EARTH_RADIUS_MILES
+
+def distance(lat1, lng1, lat2, lng2):
+  """Great circle distance in miles (spherical law of cosines)"""
+  lat1, lng1, lat2, lng2 = map(math.radians, [lat1, lng1, lat2, lng2])
+  cos_angle = (math.cos(lat1) * math.cos(lat2) * math.cos(lng2 - lng1) +
+               math.sin(lat1) * math.sin(lat2))
+  return EARTH_RADIUS_MILES * math.acos(max(-1.0, min(1.0, cos_angle)))
+
+def encode(lat, lng, precision=GEOHASH_PRECISION):
+  """Geohash of a point; nearby points share long prefixes"""
+  lat_range = [-90.0, 90.0]
+  lng_range = [-180.0, 180.0]
+  chars     = []
+  bits      = 0
+  bit_count = 0
+  even      = True
+  while len(chars) < precision:
+    rng, value = (lng_range, lng) if even else (lat_range, lat)
+    mid = (rng[0] + rng[1]) / 2
+    if value >= mid:
+      bits   = bits * 2 + 1
+      rng[0] = mid
+    else:
+      bits   = bits * 2
+      rng[1] = mid
+    even       = not even
+    bit_count += 1
+    if bit_count == 5:
+      chars.append(GEOHASH_ALPHABET[bits])
+      bits      = 0
+      bit_count = 0
+  return ''.join(chars)
+
+def decode(geohash):
+  """Center (lat, lng) of a geohash cell"""
+  lat_range = [-90.0, 90.0]
+  lng_range = [-180.0, 180.0]
+  even      = True
+  for char in geohash:
+    bits = GEOHASH_ALPHABET.index(char)
+    for shift in range(4, -1, -1):
+      rng = lng_range if even else lat_range
+      mid = (rng[0] + rng[1]) / 2
+      if bits >> shift & 1:
+        rng[0] = mid
+      else:
+        rng[1] = mid
+      even = not even
+  return (lat_range[0] + lat_range[1]) / 2, (lng_range[0] + lng_range[1]) / 2
+
+def cell_size(precision):
+  """(height, width) in degrees of a geohash cell at precision"""
+  bits = 5 * precision
+  return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+def _cell_index(value, origin, size, count):
+  return min(int(math.floor((value - origin) / size)), count - 1)
+
+def _cover_cells(north, south, east, west, precision, max_cells):
+  height, width = cell_size(precision)
+  lat_cells = int(round(180.0 / height))
+  lng_cells = int(round(360.0 / width))
+  first_row = _cell_index(south, -90.0, height, lat_cells)
+  last_row  = _cell_index(north, -90.0, height, lat_cells)
+  first_col = _cell_index(west, -180.0, width, lng_cells)
+  last_col  = _cell_index(east, -180.0, width, lng_cells)
+  # fine precisions span millions of rows; count them before listing any
+  if (last_row - first_row + 1) * (last_col - first_col + 1) > max_cells:
+    return None
+  return set(encode(-90.0 + (row + 0.5) * height, -180.0 + (col + 0.5) * width, precision)
+             for row in range(first_row, last_row + 1)
+             for col in range(first_col, last_col + 1))
+
+def cover(north, south, east, west, max_cells=MAX_COVER_CELLS):
+  """
+  Geohash prefixes whose cells together contain the bounding box, using the
+  finest precision that needs at most max_cells prefixes. Boxes crossing the
+  antimeridian have east < west. Returns None when no useful cover exists.
+  """
+  if east < west:
+    eastern = cover(north, south, 180.0, west, max_cells // 2)
+    western = cover(north, south, east, -180.0, max_cells // 2)
+    if eastern is None or western is None:
+      return None
+    return eastern + western
+  for precision in range(GEOHASH_PRECISION, 0, -1):
+    cells = _cover_cells(north, south, east, west, precision, max_cells)
+    if cells is not None:
+      return sorted(cells)
+  return None
+
+def neighbourhood(lat, lng, precision):
+  """The cell containing a point and the (up to) eight cells around it"""
+  height, width = cell_size(precision)
+  cells = set()
+  for d_lat in [-height, 0, height]:
+    for d_lng in [-width, 0, width]:
+      n_lat = max(-90.0, min(90.0, lat + d_lat))
+      n_lng = (lng + d_lng + 180.0) % 360.0 - 180.0
+      cells.add(encode(n_lat, n_lng, precision))
+  return sorted(cells)
+
+def neighbourhood_reach(lat, precision):
+  """
+  Miles from any point of a cell at latitude lat to the outside of its
+  neighbourhood, i.e. how far a search may reach while staying inside it
+  """
+  height, width = cell_size(precision)
+  edge_lat = min(90.0, abs(lat) + 2 * height)
+  across   = math.asin(math.sin(math.radians(width)) * math.cos(math.radians(edge_lat)))
+  return EARTH_RADIUS_MILES * min(math.radians(height), across)
+
+def cell_radius(geohash):
+  """Miles from the center of a cell to its farthest corner"""
+  lat, lng      = decode(geohash)
+  height, width = cell_size(len(geohash))
+  return max(distance(lat, lng, lat + height / 2, lng + width / 2),
+             distance(lat, lng, lat - height / 2, lng + width / 2))
+
+def bounding_box(lat, lng, radius):
+  """(north, south, east, west) of the box containing a radius (miles) around a point"""
+  angle = radius / float(EARTH_RADIUS_MILES)
+  north = lat + math.degrees(angle)
+  south = lat - math.degrees(angle)
+  if north >= 90.0 or south <= -90.0 or angle >= math.pi / 2:
+    return min(north, 90.0), max(south, -90.0), 180.0, -180.0
+  ratio = math.sin(angle) / math.cos(math.radians(lat))
+  if ratio >= 1.0:
+    return north, south, 180.0, -180.0
+  delta = math.degrees(math.asin(ratio))
+  east  = lng + delta
+  west  = lng - delta
+  if east > 180.0:
+    east -= 360.0
+  if west < -180.0:
+    west += 360.0
+  return north, south, east, west
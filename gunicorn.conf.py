@@ -0,0 +1,29 @@
+##################################################
+# GUNICORN CONFIG
+##################################################
+
+import os
+import multiprocessing
+
+bind    = '0.0.0.0:' + os.environ.get('PORT', '5000')
+# every worker is a separate process with its own connection pool, response
+# cache (unless MEMCACHED_SERVERS is set) and song resolver threads
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# the app reads it to tell whether it runs alone (see settings.py)
+os.environ['WEB_CONCURRENCY'] = str(workers)
+timeout = 30
+
+# WORKER_CLASS=gevent runs each worker's requests as greenlets, up to
+# WORKER_CONNECTIONS at once, switching whenever one waits on a socket: the
+# database (psycopg2, made cooperative below), memcached or a provider lookup
+worker_class       = os.environ.get('WORKER_CLASS', 'sync')
+os.environ['WORKER_CLASS'] = worker_class
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 500))
+
+# the song resolver threads must start after the fork, inside each worker
+preload_app = False
+
+def post_fork(server, worker):
+  if worker_class == 'gevent':
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -0,0 +1,145 @@
+##################################################
+# REQUEST INSTRUMENTATION
+##################################################
+
+import time
+import bisect
+import threading
+import functools
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from settings import *
+
+# every response gets a Server-Timing header with the time spent per phase;
+# with METRICS_ENDPOINT, GET /api/metrics reports latency histograms per route
+app.config.setdefault('SERVER_TIMING', True)
+app.config.setdefault('METRICS_ENDPOINT', os.environ.get('LATITUNE_METRICS') == "true")
+
+# upper bounds in milliseconds of the latency histogram buckets, plus one
+# bucket for anything slower
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+def add_timing(name, elapsed):
+  """Add elapsed seconds to a phase of the current request, if there is one"""
+  if not has_request_context():
+    return
+  if not hasattr(g, 'timings'):
+    g.timings = {}
+  entry = g.timings.setdefault(name, [0.0, 0])
+  entry[0] += elapsed
+  entry[1] += 1
+
+@contextmanager
+def phase(name):
+  """
+  Time a block as part of a phase of the current request. Blocks of a phase
+  opened inside one already running (nested serialize calls) are not counted
+  again.
+  """
+  if not has_request_context():
+    yield
+    return
+  if not hasattr(g, 'open_phases'):
+    g.open_phases = set()
+  if name in g.open_phases:
+    yield
+    return
+  g.open_phases.add(name)
+  start = time.time()
+  try:
+    yield
+  finally:
+    g.open_phases.discard(name)
+    add_timing(name, time.time() - start)
+
+def timed(name):
+  """Decorator timing every call of a function as part of a phase"""
+  def wrap(fn):
+    @functools.wraps(fn)
+    def wrapped_fn(*args, **kwargs):
+      with phase(name):
+        return fn(*args, **kwargs)
+    return wrapped_fn
+  return wrap
+
+# SQL time and statement counts, from every engine (replicas included)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault('statement_start', []).append(time.time())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+  add_timing('sql', time.time() - conn.info['statement_start'].pop())
+
+class RouteMetrics(object):
+  """Request latency histograms and phase totals per route, for this process"""
+
+  def __init__(self, buckets=HISTOGRAM_BUCKETS):
+    self.buckets = buckets
+    self.routes  = {}
+    self._lock   = threading.Lock()
+
+  def record(self, route, elapsed, timings):
+    ms = elapsed * 1000
+    with self._lock:
+      entry = self.routes.get(route)
+      if entry is None:
+        entry = self.routes[route] = {'count'    : 0,
+                                      'total_ms' : 0.0,
+                                      'buckets'  : [0] * (len(self.buckets) + 1),
+                                      'phases'   : {}}
+      entry['count']    += 1
+      entry['total_ms'] += ms
+      entry['buckets'][bisect.bisect_left(self.buckets, ms)] += 1
+      for name, (seconds, count) in timings.items():
+        totals = entry['phases'].setdefault(name, {'total_ms':0.0, 'count':0})
+        totals['total_ms'] += seconds * 1000
+        totals['count']    += count
+
+  def snapshot(self):
+    """One dict per route; buckets maps each upper bound ('inf' last) to a count"""
+    labels = [str(bound) for bound in self.buckets] + ['inf']
+    with self._lock:
+      return [{'route'    : route,
+               'count'    : entry['count'],
+               'total_ms' : entry['total_ms'],
+               'buckets'  : dict(zip(labels, entry['buckets'])),
+               'phases'   : dict((name, dict(totals)) for name, totals in entry['phases'].items())}
+              for route, entry in sorted(self.routes.items())]
+
+  def clear(self):
+    with self._lock:
+      self.routes.clear()
+
+route_metrics = RouteMetrics()
+
+def server_timing(timings, elapsed):
+  """Server-Timing header value: every phase, then the total"""
+  entries = []
+  for name, (seconds, count) in sorted(timings.items()):
+    entries.append('%s;dur=%.1f;desc="%d"' % (name, seconds * 1000, count))
+  entries.append('total;dur=%.1f' % (elapsed * 1000))
+  return ', '.join(entries)
+
+@app.before_request
+def start_request():
+  g.request_start = time.time()
+
+@app.after_request
+def finish_request(response):
+  """
+  Phases overlap: SQL run by lazy loads inside serialize counts towards both,
+  and streamed responses are timed up to their first byte.
+  """
+  if not hasattr(g, 'request_start'):
+    return response
+  elapsed = time.time() - g.request_start
+  timings = getattr(g, 'timings', {})
+  if app.config['SERVER_TIMING']:
+    response.headers['Server-Timing'] = server_timing(timings, elapsed)
+  route = request.url_rule.rule if request.url_rule else 'unmatched'
+  route_metrics.record(request.method + ' ' + route, elapsed, timings)
+  return response
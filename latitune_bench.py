@@ -0,0 +1,324 @@
+##################################################
+# BENCHMARK
+##################################################
+#
+# Seeds a database with a realistic volume of users, songs, blips, favorites
+# and comments, replays a mixed read/write workload through the app and
+# reports latency percentiles, throughput and queries per request for each
+# kind of request. The database comes from DATABASE_URL, e.g.
+#
+#   DATABASE_URL=sqlite:////tmp/latitune_bench.db python latitune_bench.py
+#   DATABASE_URL=postgresql://localhost/latitune_bench python latitune_bench.py --blips 2000000
+#
+# Requests go through app.test_client(), so timings cover the app and the
+# database but not the network or the WSGI server. With --url they go over
+# HTTP to a running deployment instead, sharing its DATABASE_URL, e.g.
+#
+#   WEB_CONCURRENCY=4 gunicorn -c gunicorn.conf.py latitune:app &
+#   python latitune_bench.py --url http://localhost:5000 --threads 8
+#
+# Queries per request are only counted in process.
+
+import sys
+import json
+import time
+import random
+import urllib
+import urllib2
+import argparse
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import event
+import latitune
+
+PASSWORD = "benchpass"
+
+# blips cluster around these (latitude, longitude) centers
+CITIES = [(40.71, -74.01), (34.05, -118.24), (41.88, -87.63), (42.36, -71.06),
+          (37.77, -122.42), (47.61, -122.33), (30.27, -97.74), (51.51, -0.13),
+          (48.86, 2.35), (52.52, 13.40), (59.33, 18.07), (41.39, 2.17),
+          (35.68, 139.69), (37.57, 126.98), (-33.87, 151.21), (-23.55, -46.63),
+          (19.43, -99.13), (43.65, -79.38), (55.76, 37.62), (1.35, 103.82)]
+# standard deviation in degrees of blips around their city
+CITY_SPREAD = 0.2
+HISTORY     = timedelta(days=90)
+BATCH_SIZE  = 10000
+
+# (name, weight) of the request mix; see Workload for what each one does
+MIX = [('nearby',           35),
+       ('nearby_radius',     5),
+       ('bounds',           10),
+       ('hot',              10),
+       ('blip_by_id',       10),
+       ('comments_by_blip', 10),
+       ('favorites_by_user', 5),
+       ('put_favorite',      5),
+       ('put_comment',       5),
+       ('put_blip',          5)]
+
+def skewed(count, alpha=1.2):
+  """Index in [0, count) from a power law, so a few indexes get most picks"""
+  return min(int(random.paretovariate(alpha)) - 1, count - 1)
+
+def near_city():
+  lat, lng = random.choice(CITIES)
+  lat = max(-90.0, min(90.0, random.gauss(lat, CITY_SPREAD)))
+  lng = (random.gauss(lng, CITY_SPREAD) + 180.0) % 360.0 - 180.0
+  return lat, lng
+
+def insert(table, rows):
+  """Insert the dicts of an iterable, BATCH_SIZE to a statement"""
+  batch = []
+  for row in rows:
+    batch.append(row)
+    if len(batch) == BATCH_SIZE:
+      latitune.db.session.execute(table.insert(), batch)
+      batch = []
+  if batch:
+    latitune.db.session.execute(table.insert(), batch)
+  latitune.db.session.commit()
+
+def seed(users, songs, blips, favorites, comments):
+  """
+  Fill a fresh schema. Favorites and comments are skewed towards a few blips
+  and spread over the time since each blip; the blips' counters and hot
+  scores are computed from them before anything is inserted. Rows are kept as
+  lists and tuples until inserted so millions of them fit in memory.
+  """
+  db = latitune.db
+  db.drop_all()
+  db.create_all()
+  now     = datetime.now()
+  pw_hash = latitune.User("bench", "bench@example.com", PASSWORD).pw_hash
+  scoring = latitune.scoring
+
+  insert(latitune.User.__table__,
+         ({'id':i, 'name':'user%d' % i, 'email':'user%d@example.com' % i, 'pw_hash':pw_hash}
+          for i in range(1, users + 1)))
+  insert(latitune.Song.__table__,
+         ({'id':i, 'artist':'Artist %d' % (i % 5000), 'title':'Song %d' % i, 'album':'',
+           'normalized_key':latitune.providers.normalize(u'Artist %d' % (i % 5000), u'Song %d' % i),
+           'provider_key':'Youtube', 'provider_song_id':'bench%d' % i,
+           'provider_state':latitune.PROVIDER_RESOLVED}
+          for i in range(1, songs + 1)))
+
+  # [song_id, user_id, latitude, longitude, timestamp, favorites, comments, hot_score]
+  blip_rows = []
+  for i in range(blips):
+    lat, lng  = near_city()
+    timestamp = now - timedelta(seconds=random.random() * HISTORY.total_seconds())
+    blip_rows.append([skewed(songs) + 1, random.randint(1, users), lat, lng, timestamp,
+                      0, 0, scoring.initial_score(timestamp)])
+
+  def add_event(index, column, weight):
+    row  = blip_rows[index]
+    when = row[4] + timedelta(seconds=random.random() * (now - row[4]).total_seconds())
+    row[column] += 1
+    row[7]       = scoring.add_event(row[7], weight, when)
+    return when
+
+  favorite_rows = {}
+  while len(favorite_rows) < min(favorites, users * blips):
+    pair = (random.randint(1, users), skewed(blips))
+    if pair not in favorite_rows:
+      favorite_rows[pair] = add_event(pair[1], 5, scoring.FAVORITE_WEIGHT)
+  comment_rows = []
+  for i in range(comments):
+    index = skewed(blips)
+    comment_rows.append((random.randint(1, users), index, add_event(index, 6, scoring.COMMENT_WEIGHT)))
+
+  insert(latitune.Blip.__table__,
+         ({'id':i + 1, 'song_id':row[0], 'user_id':row[1], 'latitude':row[2], 'longitude':row[3],
+           'geohash':latitune.geo.encode(row[2], row[3]), 'timestamp':row[4], 'modified':row[4],
+           'favorite_count':row[5], 'comment_count':row[6], 'hot_score':row[7]}
+          for i, row in enumerate(blip_rows)))
+  insert(latitune.Favorite.__table__,
+         ({'user_id':user_id, 'blip_id':index + 1, 'timestamp':when}
+          for (user_id, index), when in favorite_rows.iteritems()))
+  insert(latitune.Comment.__table__,
+         ({'user_id':user_id, 'blip_id':index + 1, 'comment':'comment %d' % i, 'timestamp':when}
+          for i, (user_id, index, when) in enumerate(comment_rows)))
+
+  # ids were given explicitly, so move postgres sequences past them
+  if db.engine.name == 'postgresql':
+    for table in ['user', 'song', 'blip']:
+      db.session.execute("SELECT setval(pg_get_serial_sequence('\"%s\"', 'id'), (SELECT max(id) FROM \"%s\"))"
+                         % (table, table))
+    db.session.commit()
+
+class Workload(object):
+  """Builds and issues one request of each kind in MIX"""
+
+  def __init__(self, client, users, blips, songs):
+    self.client = client
+    self.users  = users
+    self.blips  = blips
+    self.songs  = songs
+
+  def auth(self):
+    return {'user_id':random.randint(1, self.users), 'password':PASSWORD}
+
+  def blip_id(self):
+    return skewed(self.blips) + 1
+
+  def nearby(self):
+    lat, lng = near_city()
+    return self.client.get('/api/blip?latitude=%f&longitude=%f' % (lat, lng))
+
+  def nearby_radius(self):
+    lat, lng = near_city()
+    return self.client.get('/api/blip?latitude=%f&longitude=%f&radius=5' % (lat, lng))
+
+  def bounds(self):
+    lat, lng = near_city()
+    return self.client.get('/api/blip?north=%f&south=%f&east=%f&west=%f' %
+                           (lat + 0.1, lat - 0.1, lng + 0.1, lng - 0.1))
+
+  def hot(self):
+    lat, lng = near_city()
+    return self.client.get('/api/blip?latitude=%f&longitude=%f&sort=hot' % (lat, lng))
+
+  def blip_by_id(self):
+    return self.client.get('/api/blip?id=%d' % self.blip_id())
+
+  def comments_by_blip(self):
+    return self.client.get('/api/blip/comment?blip_id=%d' % self.blip_id())
+
+  def favorites_by_user(self):
+    return self.client.get('/api/blip/favorite?user_id=%d' % random.randint(1, self.users))
+
+  def put_favorite(self):
+    return self.client.put('/api/blip/favorite', data=dict(self.auth(), blip_id=self.blip_id()))
+
+  def put_comment(self):
+    return self.client.put('/api/blip/comment', data=dict(self.auth(), blip_id=self.blip_id(),
+                                                          comment='bench comment'))
+
+  def put_blip(self):
+    lat, lng = near_city()
+    return self.client.put('/api/blip', data=dict(self.auth(), song_id=skewed(self.songs) + 1,
+                                                  latitude=lat, longitude=lng))
+
+class HTTPResponse(object):
+  def __init__(self, status_code, data):
+    self.status_code = status_code
+    self.data        = data
+
+class HTTPClient(object):
+  """The part of the test client interface Workload uses, over HTTP"""
+
+  def __init__(self, url):
+    self.url = url.rstrip('/')
+
+  def request(self, method, path, data=None):
+    request = urllib2.Request(self.url + path, urllib.urlencode(data) if data else None)
+    request.get_method = lambda: method
+    try:
+      response = urllib2.urlopen(request)
+      return HTTPResponse(response.getcode(), response.read())
+    except urllib2.HTTPError as e:
+      return HTTPResponse(e.code, e.read())
+
+  def get(self, path):
+    return self.request('GET', path)
+
+  def put(self, path, data=None):
+    return self.request('PUT', path, data)
+
+class Recorder(object):
+  """Per-thread SQL statement counts, through the engine's cursor events"""
+
+  def __init__(self, engine):
+    self.local = threading.local()
+    event.listen(engine, 'before_cursor_execute', self.record)
+
+  def record(self, conn, cursor, statement, parameters, context, executemany):
+    self.local.count = getattr(self.local, 'count', 0) + 1
+
+  def reset(self):
+    self.local.count = 0
+
+  def count(self):
+    return getattr(self.local, 'count', 0)
+
+def percentile(values, fraction):
+  """Nearest-rank percentile of sorted values"""
+  return values[max(0, int(round(fraction * len(values))) - 1)]
+
+def api_status(response):
+  """meta.status of a response, None for an empty (304) or non-JSON body"""
+  try:
+    return json.loads(response.data)['meta']['status']
+  except (ValueError, KeyError, TypeError):
+    return None
+
+def run(requests, threads, users, blips, songs, url=None):
+  names    = [name for name, weight in MIX for i in range(weight)]
+  recorder = None if url else Recorder(latitune.db.engine)
+  results  = dict((name, []) for name, weight in MIX)
+  failures = []
+  lock     = threading.Lock()
+
+  def worker(count):
+    client   = HTTPClient(url) if url else latitune.app.test_client()
+    workload = Workload(client, users, blips, songs)
+    for i in range(count):
+      name = random.choice(names)
+      if recorder:
+        recorder.reset()
+      start    = time.time()
+      response = getattr(workload, name)()
+      elapsed  = time.time() - start
+      with lock:
+        results[name].append((elapsed, recorder.count() if recorder else 0))
+        # the API answers errors with a 200 and a non-success meta.status
+        if response.status_code not in (200, 304):
+          failures.append((name, response.status_code))
+        elif response.status_code == 200 and api_status(response) != latitune.SUCCESS:
+          failures.append((name, api_status(response)))
+
+  start   = time.time()
+  workers = [threading.Thread(target=worker, args=(requests // threads,)) for i in range(threads)]
+  for thread in workers:
+    thread.start()
+  for thread in workers:
+    thread.join()
+  elapsed = time.time() - start
+
+  total = sum(len(samples) for samples in results.values())
+  print '%d requests in %.1fs: %.1f requests/s, %d failed' % (total, elapsed, total / elapsed, len(failures))
+  print '%-18s %7s %9s %9s %9s %9s' % ('request', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'queries')
+  for name, weight in MIX:
+    samples = results[name]
+    if not samples:
+      continue
+    times   = sorted(elapsed * 1000 for elapsed, queries in samples)
+    queries = sum(queries for elapsed, queries in samples) / float(len(samples))
+    print '%-18s %7d %9.1f %9.1f %9.1f %9s' % (name, len(samples), percentile(times, 0.50),
+                                               percentile(times, 0.95), percentile(times, 0.99),
+                                               '%.1f' % queries if recorder else '-')
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Seed and benchmark the latitune API")
+  parser.add_argument('--users',     type=int, default=10000)
+  parser.add_argument('--songs',     type=int, default=50000)
+  parser.add_argument('--blips',     type=int, default=1000000)
+  parser.add_argument('--favorites', type=int, default=2000000)
+  parser.add_argument('--comments',  type=int, default=500000)
+  parser.add_argument('--requests',  type=int, default=10000)
+  parser.add_argument('--threads',   type=int, default=1)
+  parser.add_argument('--seed',      type=int, default=0, help="random seed")
+  parser.add_argument('--no-seed',   action='store_true', help="reuse the data already in the database")
+  parser.add_argument('--url',       help="benchmark the deployment serving this URL instead of the app in process")
+  args = parser.parse_args(argv)
+
+  random.seed(args.seed)
+  latitune.app.config['SONG_RESOLVER_WORKERS'] = 0
+  if not args.no_seed:
+    start = time.time()
+    seed(args.users, args.songs, args.blips, args.favorites, args.comments)
+    print 'seeded in %.1fs' % (time.time() - start)
+  run(args.requests, args.threads, args.users, args.blips, args.songs, args.url)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
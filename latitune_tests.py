@@ -1,9 +1,41 @@
 import os
 import latitune
+import feed
+import push
 import unittest
 import tempfile
-from datetime import datetime
+import math
+from datetime import datetime, timedelta
 import ast
+import json
+import Queue
+from sqlalchemy import event
+
+executed_statements = []
+
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+  executed_statements.append(statement)
+
+event.listen(latitune.db.engine, 'before_cursor_execute', record_statement)
+
+executed_commits = []
+
+def record_commit(conn):
+  executed_commits.append(conn)
+
+event.listen(latitune.db.engine, 'commit', record_commit)
+
+class FakeProvider(object):
+  """Stands in for YouTube; unknown songs raise like a failed lookup"""
+  key = "Youtube"
+
+  def __init__(self, songs):
+    self.songs   = songs
+    self.lookups = []
+
+  def lookup(self, artist, title):
+    self.lookups.append((artist, title))
+    return self.songs[(artist, title)]
 
 class latituneTestCase(unittest.TestCase):
 
@@ -75,12 +107,30 @@ class latituneTestCase(unittest.TestCase):
       blip_id  = blip_id
     ))
 
+  def countQueries(self, url):
+    del executed_statements[:]
+    self.app.get(url)
+    return len(executed_statements)
+
   """
   Test stuff
   """
 
   def setUp(self):
     latitune.db.create_all()
+    latitune.app.config['SONG_RESOLVER_WORKERS'] = 0
+    latitune.app.config['SONG_RESOLVER_BACKOFF'] = 0
+    latitune.app.config['SONG_RESOLVER_ATTEMPTS'] = 5
+    latitune.song_resolver.queue = Queue.Queue()
+    latitune.provider_cache.memory.clear()
+    latitune.response_cache.backend = latitune.LocalBackend()
+    latitune.nearby_cache.candidates = latitune.NEARBY_CANDIDATES
+    latitune.hot_index.clear()
+    latitune.route_metrics.clear()
+    latitune.timelines.clear()
+    latitune.timelines.fanout_limit = feed.FANOUT_LIMIT
+    latitune.timelines.length       = feed.TIMELINE_LENGTH
+    latitune.timelines.trim_rate    = feed.TIMELINE_TRIM_RATE
     self.app = latitune.app.test_client()
 
   def tearDown(self):
@@ -127,7 +177,7 @@ class latituneTestCase(unittest.TestCase):
     latitune.db.session.add(song)
     latitune.db.session.commit()
     serialized = song.serialize
-    assert serialized == {"id":1,"artist":"The Kinks","title":"Big Sky","album":"","provider_key":"Youtube","provider_song_id":"wiyrFSSG5_g"}
+    assert serialized == {"id":1,"artist":"The Kinks","title":"Big Sky","album":"","provider_key":"Youtube","provider_song_id":"wiyrFSSG5_g","provider_state":"resolved"}
 
   """ Blip """
 
@@ -159,7 +209,20 @@ class latituneTestCase(unittest.TestCase):
     serialized = blip.serialize
     assert serialized == {"id":1, "song":song.serialize, "user_id":user.id,
                          "longitude":50.0, "latitude":50.0,
-                         "timestamp":now.isoformat()}
+                         "timestamp":now.isoformat(),
+                         "favorite_count":0, "comment_count":0}
+
+  def test_blip_geohash_encodes(self):
+    assert latitune.geo.encode(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    blip = latitune.Blip(1, 1, 10.40744, 57.64911)
+    assert blip.geohash.startswith("u4pruydqqvj")
+
+  def test_geohash_cover_of_large_boxes(self):
+    # finest precision cells are counted, not listed: this box spans ~10^12 of them
+    cells = latitune.geo.cover(60.0, 10.0, 50.0, -50.0)
+    assert 0 < len(cells) <= latitune.geo.MAX_COVER_CELLS
+    assert latitune.geo.cover(90.0, -90.0, 180.0, -180.0, max_cells=1) is None
+    assert len(latitune.geo.cover(10.0, -10.0, -170.0, 170.0)) <= latitune.geo.MAX_COVER_CELLS
 
   """ Comment """
 
@@ -231,6 +294,37 @@ class latituneTestCase(unittest.TestCase):
     serialized = favorite.serialize
     assert serialized == {"id":1,"user_id":user.id,"blip_id":blip.id}
 
+  """ Cache """
+
+  def test_lru_cache_evicts_least_recently_used(self):
+    cache = latitune.LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+  def test_lru_cache_expires_entries(self):
+    now = [0]
+    cache = latitune.LRUCache(max_size=2, ttl=10, clock=lambda: now[0])
+    cache.set("a", 1)
+    now[0] = 9
+    assert cache.get("a") == 1
+    now[0] = 10
+    assert cache.get("a") is None
+
+  def test_response_cache_invalidates_tags(self):
+    for backend in [latitune.LocalBackend(), latitune.SharedBackend(latitune.DictClient())]:
+      cache = latitune.ResponseCache(backend)
+      cache.set("key", "value", cache.versions(["a", "b"]))
+      assert cache.get("key") == "value"
+      cache.invalidate("c")
+      assert cache.get("key") == "value"
+      cache.invalidate("b")
+      assert cache.get("key") is None
+
   """
   View Tests
   """
@@ -268,12 +362,121 @@ class latituneTestCase(unittest.TestCase):
     rv = self.app.get('/api/user?username=ben2&password=testpass')
     assert ast.literal_eval(rv.data) == {"meta":{"status":33,"error":"Username does not exist"},"objects":[]}
 
+  def test_user_authentication_is_cached(self):
+    self.generateUser()
+    hashes = []
+    check_password = latitune.User.check_password
+    def counting_check_password(user, password):
+      hashes.append(password)
+      return check_password(user, password)
+    latitune.User.check_password = counting_check_password
+    try:
+      for i in range(3):
+        rv = self.app.get('/api/user?username=ben&password=testpass')
+        assert ast.literal_eval(rv.data)['meta'] == {"status":20}
+      rv = self.app.get('/api/user?username=ben&password=testpa')
+      assert ast.literal_eval(rv.data)['meta']['status'] == 32
+    finally:
+      latitune.User.check_password = check_password
+    assert hashes == ["testpass", "testpa"]
+
   """ Song """
 
   def test_new_song_creates_song_with_valid_data(self):
     rv = self.createSong("The Kinks","Big Sky")
     assert ast.literal_eval(rv.data) == {"meta": {"status": 20},
-                                         "objects": [{"id":1,"artist":"The Kinks","title":"Big Sky","album":"","provider_key":"Youtube","provider_song_id":"wiyrFSSG5_g"}]}
+                                         "objects": [{"id":1,"artist":"The Kinks","title":"Big Sky","album":"","provider_key":"Youtube","provider_song_id":"","provider_state":"pending"}]}
+
+  def test_new_song_resolves_provider_in_background(self):
+    provider = FakeProvider({("The Kinks","Big Sky"):"abc123"})
+    latitune.Song.provider = provider
+    try:
+      self.createSong("The Kinks","Big Sky")
+      latitune.song_resolver.drain()
+    finally:
+      latitune.Song.provider = latitune.providers.youtube
+    song = latitune.Song.query.get(1)
+    assert song.provider_state == "resolved"
+    assert song.provider_song_id == "abc123"
+
+  def test_new_song_uses_cached_provider_lookup(self):
+    provider = FakeProvider({("The Kinks","Big Sky"):"abc123"})
+    latitune.Song.provider = provider
+    try:
+      self.createSong("The Kinks","Big Sky")
+      latitune.song_resolver.drain()
+      rv = self.createSong(" the kinks","BIG  SKY")
+      assert ast.literal_eval(rv.data)['objects'][0]['provider_song_id'] == "abc123"
+      latitune.provider_cache.memory.clear()
+      rv = self.createSong("the kinks","big sky")
+      assert ast.literal_eval(rv.data)['objects'][0]['provider_state'] == "resolved"
+    finally:
+      latitune.Song.provider = latitune.providers.youtube
+    assert provider.lookups == [("The Kinks","Big Sky")]
+
+  def test_new_song_deduplicates_normalized_names(self):
+    first  = ast.literal_eval(self.createSong("The Kinks","Big Sky").data)['objects'][0]
+    second = ast.literal_eval(self.createSong("the kinks ","big  sky").data)['objects'][0]
+    assert first == second
+    assert latitune.Song.query.count() == 1
+    assert latitune.SearchTerm.query.filter_by(kind='song').count() == 4
+
+  def test_song_upsert_reports_insertion(self):
+    # takes the ON CONFLICT statement when DATABASE_URL names a Postgres database
+    song, inserted = latitune.Song.upsert(latitune.Song("The Kinks", "Big Sky", resolve=False))
+    latitune.db.session.commit()
+    assert (song.id, inserted) == (1, True)
+    song, inserted = latitune.Song.upsert(latitune.Song("the kinks ", "big  sky", resolve=False))
+    latitune.db.session.commit()
+    assert (song.id, song.title, inserted) == (1, "Big Sky", False)
+    assert latitune.Song.query.count() == 1
+
+  def test_merge_duplicate_songs(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    latitune.db.session.execute(latitune.Song.__table__.insert(),
+                                [{'artist':'The Kinks', 'title':'Waterloo Sunset'},
+                                 {'artist':'the kinks', 'title':'waterloo sunset '}])
+    latitune.Blip.query.filter_by(id=blip_dict['id']).update({'song_id':3})
+    latitune.db.session.commit()
+    assert latitune.Song.merge_duplicates() == 1
+    assert [song.id for song in latitune.Song.query.order_by(latitune.Song.id)] == [1, 2]
+    assert latitune.Blip.query.get(blip_dict['id']).song_id == 2
+    assert latitune.Song.query.get(2).normalized_key == latitune.providers.normalize(u"The Kinks", u"Waterloo Sunset")
+
+  def test_resolver_skips_songs_claimed_elsewhere(self):
+    provider = FakeProvider({("The Kinks","Big Sky"):"abc123"})
+    latitune.Song.provider = provider
+    try:
+      self.createSong("The Kinks","Big Sky")
+      # another process's worker holds the lease
+      latitune.Song.query.filter_by(id=1).update({'provider_claimed':datetime.now()})
+      latitune.db.session.commit()
+      latitune.song_resolver.drain()
+      latitune.song_resolver.requeue_pending()
+      assert latitune.song_resolver.queue.empty()
+      assert provider.lookups == []
+      # its lease runs out
+      latitune.Song.query.filter_by(id=1).update({'provider_claimed':datetime.now() - timedelta(hours=1)})
+      latitune.db.session.commit()
+      latitune.song_resolver.requeue_pending()
+      latitune.song_resolver.drain()
+    finally:
+      latitune.Song.provider = latitune.providers.youtube
+    assert provider.lookups == [("The Kinks","Big Sky")]
+    assert latitune.Song.query.get(1).provider_state == "resolved"
+
+  def test_new_song_retries_then_fails_provider_lookup(self):
+    latitune.app.config['SONG_RESOLVER_ATTEMPTS'] = 3
+    provider = FakeProvider({})
+    latitune.Song.provider = provider
+    try:
+      self.createSong("The Kinks","Big Sky")
+      latitune.song_resolver.drain()
+    finally:
+      latitune.Song.provider = latitune.providers.youtube
+    song = latitune.Song.query.get(1)
+    assert song.provider_state == "failed"
+    assert provider.lookups == [("The Kinks","Big Sky")] * 3
 
   def test_new_song_creates_song_with_invalid_data(self):
     rv = self.app.put("/api/song",data=dict(
@@ -299,7 +502,9 @@ class latituneTestCase(unittest.TestCase):
                                     "user_id"   : user_dict['id'],
                                     "longitude" : 50.0,
                                     "latitude"  : 50.0,
-                                    "timestamp" : now}]}
+                                    "timestamp" : now,
+                                    "favorite_count" : 0,
+                                    "comment_count" : 0}]}
 
   def test_new_blip_creates_blip_with_invalid_data(self):
     rv = self.app.put("/api/blip",data=dict(
@@ -334,6 +539,37 @@ class latituneTestCase(unittest.TestCase):
 
     assert ast.literal_eval(rv.data) == {"meta": {"status":32, "error": "Invalid Authentication"}, "objects": []}
 
+  def test_new_blips_in_batch(self):
+    user_dict = self.generateUser()
+    song_dict = self.generateSong()
+    blips = [{"song_id":song_dict['id'],"latitude":50.0,"longitude":50.0},
+             {"song_id":123,"latitude":50.0,"longitude":50.0},
+             {"song_id":song_dict['id'],"latitude":50.0},
+             {"song_id":song_dict['id'],"latitude":"north","longitude":50.0},
+             {"song_id":str(song_dict['id']),"latitude":"51.0","longitude":"51.0"}]
+    rv = self.app.put("/api/blip/batch",data=dict(
+        blips    = json.dumps(blips),
+        user_id  = user_dict['id'],
+        password = "testpass",
+      ))
+    assert ast.literal_eval(rv.data) == {"meta":{"status":20},
+                                         "objects":[{"status":20},
+                                                    {"status":40,"error":"Song ID does not exist"},
+                                                    {"status":10,"error":"Missing Required Parameters"},
+                                                    {"status":12,"error":"Malformed Parameters"},
+                                                    {"status":20}]}
+
+    rv_dict = ast.literal_eval(self.app.get('/api/blip?latitude=50.0&longitude=50.0').data)
+    assert [(blip['latitude'], blip['user_id']) for blip in rv_dict['objects']] == [(50.0, 1), (51.0, 1)]
+
+  def test_new_blips_in_batch_with_invalid_data(self):
+    user_dict = self.generateUser()
+    rv = self.app.put("/api/blip/batch",data=dict(blips="[", user_id=1, password="testpass"))
+    assert ast.literal_eval(rv.data) == {"meta":{"status":12,"error":"Malformed Parameters"},"objects":[]}
+
+    rv = self.app.put("/api/blip/batch",data=dict(blips="[]", user_id=1, password="testpass123"))
+    assert ast.literal_eval(rv.data) == {"meta":{"status":32,"error":"Invalid Authentication"},"objects":[]}
+
   def test_get_blip_by_id_with_valid_data(self):
     user_dict = self.generateUser()
     song_dict = self.generateSong()
@@ -351,7 +587,9 @@ class latituneTestCase(unittest.TestCase):
                                    "user_id"   : user_dict['id'],
                                    "longitude" : 50.0,
                                    "latitude"  : 50.0,
-                                   "timestamp" : now}]}
+                                   "timestamp" : now,
+                                   "favorite_count" : 0,
+                                   "comment_count" : 0}]}
 
   def test_get_nearby_blips_with_valid_data(self):
     user_dict = self.generateUser()
@@ -371,13 +609,223 @@ class latituneTestCase(unittest.TestCase):
                                      "user_id"   : user_dict['id'],
                                      "longitude" : 50.0,
                                      "latitude"  : 50.0,
-                                     "timestamp" : now},
+                                     "timestamp" : now,
+                                     "favorite_count" : 0,
+                                     "comment_count" : 0},
                                     {"id"        : 2,
                                      "song"      : song_dict,
                                      "user_id"   : user_dict['id'],
                                      "longitude" : 51.0,
                                      "latitude"  : 51.0,
-                                     "timestamp" : now}]}
+                                     "timestamp" : now,
+                                     "favorite_count" : 0,
+                                     "comment_count" : 0}]}
+
+  def test_get_blip_is_conditional(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    for url in ['/api/blip?id=1', '/api/blip', '/api/blip?latitude=50.0&longitude=50.0',
+                '/api/blip?north=51&south=49&east=51&west=49']:
+      etag = self.app.get(url).headers['ETag']
+      # answered from the validators alone, before any blip is loaded
+      del executed_statements[:]
+      rv = self.app.get(url, headers=[('If-None-Match', etag)])
+      assert rv.status_code == 304
+      assert not [statement for statement in executed_statements if 'blip.song_id' in statement]
+
+      # favoriting updates the blip's modified time
+      self.createFavorite(1,"testpass",1)
+      self.app.delete("/api/blip/favorite?user_id=1&blip_id=1&password=testpass")
+      assert self.app.get(url, headers=[('If-None-Match', etag)]).status_code == 200
+
+  def test_get_blip_does_not_commit(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    del executed_commits[:]
+    for url in ['/api/blip?latitude=50.0&longitude=50.0', '/api/blip?id=1', '/api/blip']:
+      assert ast.literal_eval(self.app.get(url).data)['meta'] == {"status":20}
+    assert executed_commits == []
+
+  def test_get_blip_reads_from_replica(self):
+    latitune.app.config['SQLALCHEMY_BINDS']  = {'replica_test': 'sqlite://'}
+    latitune.app.config['DATABASE_REPLICAS'] = ['replica_test']
+    try:
+      replica = latitune.db.get_engine(latitune.app, 'replica_test')
+      latitune.db.Model.metadata.create_all(replica)
+      replica.execute(latitune.Song.__table__.insert(), id=1, artist="The Kinks", title="Big Sky",
+                      provider_state="resolved")
+      replica.execute(latitune.Blip.__table__.insert(), id=1, song_id=1, user_id=1,
+                      latitude=10.0, longitude=10.0, timestamp=datetime.now(), modified=datetime.now())
+
+      # the primary has no blips; a fresh client reads the replica's
+      rv_dict = json.loads(latitune.app.test_client().get('/api/blip?limit=5').data)
+      assert [blip['latitude'] for blip in rv_dict['objects']] == [10.0]
+
+      # a client that just wrote reads its write back from the primary
+      user_dict, song_dict, blip_dict = self.generateBlip()
+      rv_dict = json.loads(self.app.get('/api/blip?limit=5').data)
+      assert [blip['latitude'] for blip in rv_dict['objects']] == [50.0]
+    finally:
+      latitune.app.config['SQLALCHEMY_BINDS']  = None
+      latitune.app.config['DATABASE_REPLICAS'] = []
+
+  def test_backfill_geohashes_restores_location_queries(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    # as stored before the column was added
+    latitune.Blip.query.update({'geohash':None}, synchronize_session=False)
+    latitune.db.session.commit()
+    assert latitune.Blip.within_radius(50.0, 50.0, 10) == []
+    assert latitune.Blip.backfill_geohashes() == 1
+    assert latitune.Blip.backfill_geohashes() == 0
+    assert [b_id for distance, b_id in latitune.Blip.within_radius(50.0, 50.0, 10)] == [blip_dict['id']]
+
+  def test_recount_fills_in_blip_counters(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    self.createFavorite(user_dict['id'], "testpass", blip_dict['id'])
+    self.createComment(user_dict['id'], "testpass", blip_dict['id'], "This is a comment")
+    self.createComment(user_dict['id'], "testpass", blip_dict['id'], "This is another comment")
+    # as stored before the counters were kept
+    latitune.Blip.query.update({'favorite_count':0, 'comment_count':0}, synchronize_session=False)
+    latitune.db.session.commit()
+    assert latitune.Blip.recount() == 1
+    assert latitune.Blip.recount() == 0
+    blip = latitune.Blip.query.get(blip_dict['id'])
+    assert (blip.favorite_count, blip.comment_count) == (1, 2)
+
+  def test_writer_skips_caches_refilled_from_replica(self):
+    latitune.app.config['SQLALCHEMY_BINDS']  = {'replica_lag_test': 'sqlite://'}
+    latitune.app.config['DATABASE_REPLICAS'] = ['replica_lag_test']
+    try:
+      replica = latitune.db.get_engine(latitune.app, 'replica_lag_test')
+      latitune.db.Model.metadata.create_all(replica)
+
+      user_dict, song_dict, blip_dict = self.generateBlip()
+      self.createComment(user_dict['id'], "testpass", blip_dict['id'], "This is a comment")
+
+      # a client without the cookie caches the lagging replica's answers
+      reader = latitune.app.test_client()
+      comments_url = '/api/blip/comment?blip_id=%d' % blip_dict['id']
+      nearby_url   = '/api/blip?latitude=50.0&longitude=50.0'
+      assert json.loads(reader.get(comments_url).data)['objects'] == []
+      assert json.loads(reader.get(nearby_url).data)['objects'] == []
+
+      # the writer still reads its writes back
+      rv_dict = json.loads(self.app.get(comments_url).data)
+      assert [comment['comment'] for comment in rv_dict['objects']] == ["This is a comment"]
+      rv_dict = json.loads(self.app.get(nearby_url).data)
+      assert [blip['id'] for blip in rv_dict['objects']] == [blip_dict['id']]
+    finally:
+      latitune.app.config['SQLALCHEMY_BINDS']  = None
+      latitune.app.config['DATABASE_REPLICAS'] = []
+
+  def test_get_blip_reports_server_timing(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    rv = self.app.get('/api/blip?latitude=50.0&longitude=50.0')
+    phases = dict(entry.split(';')[0:2] for entry in rv.headers['Server-Timing'].split(', '))
+    assert set(['sql', 'serialize', 'encode', 'total']) <= set(phases)
+
+    rv = self.app.put("/api/blip/favorite",data=dict(user_id=1,password="testpass",blip_id=1))
+    assert 'auth;' in rv.headers['Server-Timing']
+
+  def test_metrics_endpoint(self):
+    assert self.app.get('/api/metrics').status_code == 404
+    latitune.app.config['METRICS_ENDPOINT'] = True
+    try:
+      user_dict, song_dict, blip_dict = self.generateBlip()
+      self.app.get('/api/blip?id=1')
+      self.app.get('/api/blip?id=1')
+      rv_dict = json.loads(self.app.get('/api/metrics').data)
+      routes = dict((route['route'], route) for route in rv_dict['objects'])
+      assert routes['GET /api/blip']['count'] == 2
+      assert sum(routes['GET /api/blip']['buckets'].values()) == 2
+      assert routes['PUT /api/blip']['phases']['auth']['count'] == 1
+    finally:
+      latitune.app.config['METRICS_ENDPOINT'] = False
+
+  def test_get_nearby_blips_orders_by_distance(self):
+    user_dict = self.generateUser()
+    song_dict = self.generateSong()
+    self.createBlip("10.0","10.0",song_dict['id'],user_dict['id'],"testpass")
+    self.createBlip("50.1","50.1",song_dict['id'],user_dict['id'],"testpass")
+    self.createBlip("-40.0","120.0",song_dict['id'],user_dict['id'],"testpass")
+    self.createBlip("50.0","50.0",song_dict['id'],user_dict['id'],"testpass")
+
+    rv = self.app.get('/api/blip?latitude=50.0&longitude=50.0')
+    rv_dict = ast.literal_eval(rv.data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [4, 2, 1, 3]
+
+  def test_get_blips_with_malformed_coordinates(self):
+    for query in ["latitude=50&longitude=50&radius=x", "latitude=x&longitude=50",
+                  "north=1&south=0&east=1&west=x", "latitude=50&longitude=50&radius=501",
+                  "latitude=50&longitude=50&radius=nan"]:
+      rv = self.app.get('/api/blip?' + query)
+      assert rv.status_code == 200
+      assert json.loads(rv.data)['meta'] == {"status":12, "error":"Malformed Parameters"}
+
+  def test_response_cache_is_off_for_several_workers_without_memcached(self):
+    latitune.app.config['WORKER_PROCESSES'] = 3
+    try:
+      cache = latitune.make_response_cache()
+    finally:
+      latitune.app.config['WORKER_PROCESSES'] = 1
+    assert isinstance(cache.backend, latitune.NullBackend)
+    cache.set('key', 'value', cache.versions(['tag']))
+    assert cache.get('key') is None
+    assert isinstance(latitune.make_response_cache().backend, latitune.LocalBackend)
+
+  def test_get_nearby_blips_is_cached_per_cell(self):
+    latitune.nearby_cache.candidates = 2
+    user_dict = self.generateUser()
+    song_dict = self.generateSong()
+    self.createBlip("50.0","50.0",song_dict['id'],user_dict['id'],"testpass")
+    self.createBlip("50.002","50.002",song_dict['id'],user_dict['id'],"testpass")
+    self.createBlip("50.004","50.004",song_dict['id'],user_dict['id'],"testpass")
+
+    url = '/api/blip?latitude=50.0&longitude=50.0&limit=2'
+    rv_dict = ast.literal_eval(self.app.get(url).data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [1, 2]
+    # only the blips themselves (and their version) are loaded once the cell is cached
+    assert self.countQueries(url) == 2
+    rv_dict = ast.literal_eval(self.app.get('/api/blip?latitude=50.004&longitude=50.004&limit=2').data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [3, 2]
+
+    # a blip far away leaves the cell alone, a close one refreshes it
+    self.createBlip("10.0","10.0",song_dict['id'],user_dict['id'],"testpass")
+    assert self.countQueries(url) == 2
+    self.createBlip("50.0001","50.0001",song_dict['id'],user_dict['id'],"testpass")
+    rv_dict = ast.literal_eval(self.app.get(url).data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [1, 5]
+
+  def test_get_blips_within_radius(self):
+    user_dict = self.generateUser()
+    song_dict = self.generateSong()
+    self.createBlip("50.0","50.0",song_dict['id'],user_dict['id'],"testpass")
+    self.createBlip("50.1","50.1",song_dict['id'],user_dict['id'],"testpass")
+    self.createBlip("51.0","51.0",song_dict['id'],user_dict['id'],"testpass")
+
+    rv = self.app.get('/api/blip?latitude=50.0&longitude=50.0&radius=20')
+    rv_dict = ast.literal_eval(rv.data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [1, 2]
+
+    rv = self.app.get('/api/blip?latitude=50.0&longitude=50.0&radius=20&limit=1')
+    rv_dict = ast.literal_eval(rv.data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [1]
+
+  def test_get_blips_within_bounds(self):
+    user_dict = self.generateUser()
+    song_dict = self.generateSong()
+    self.createBlip("50.0","50.0",song_dict['id'],user_dict['id'],"testpass")
+    self.createBlip("50.5","179.5",song_dict['id'],user_dict['id'],"testpass")
+    self.createBlip("50.5","-179.5",song_dict['id'],user_dict['id'],"testpass")
+
+    rv = self.app.get('/api/blip?north=51&south=49&east=51&west=49')
+    rv_dict = ast.literal_eval(rv.data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [1]
+
+    rv = self.app.get('/api/blip?north=51&south=49&east=-179&west=179')
+    rv_dict = ast.literal_eval(rv.data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [3, 2]
+
+    rv = self.app.get('/api/blip?north=51&south=49')
+    assert ast.literal_eval(rv.data) == {"meta":{"status":10,"error":"Missing Required Parameters"},"objects":[]}
 
   def test_get_all_blips_with_valid_data(self):
     user_dict = self.generateUser()
@@ -397,13 +845,74 @@ class latituneTestCase(unittest.TestCase):
                                      "user_id"   : user_dict['id'],
                                      "longitude" : 50.0,
                                      "latitude"  : 50.0,
-                                     "timestamp" : now},
+                                     "timestamp" : now,
+                                     "favorite_count" : 0,
+                                     "comment_count" : 0},
                                     {"id"        : 2,
                                      "song"      : song_dict,
                                      "user_id"   : user_dict['id'],
                                      "longitude" : 51.0,
                                      "latitude"  : 51.0,
-                                     "timestamp" : now}]}
+                                     "timestamp" : now,
+                                     "favorite_count" : 0,
+                                     "comment_count" : 0}]}
+
+  def test_get_all_blips_paginates(self):
+    user_dict = self.generateUser()
+    song_dict = self.generateSong()
+    for i in range(3):
+      self.createBlip("50.0","50.0",song_dict['id'],user_dict['id'],"testpass")
+
+    rv_dict = ast.literal_eval(self.app.get('/api/blip?limit=2').data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [1, 2]
+    cursor = rv_dict['meta']['next_cursor']
+
+    rv_dict = ast.literal_eval(self.app.get('/api/blip?limit=2&cursor={0}'.format(cursor)).data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [3]
+    assert rv_dict['meta'] == {"status":20}
+
+    rv = self.app.get('/api/blip?cursor=garbage')
+    assert ast.literal_eval(rv.data) == {"meta":{"status":11,"error":"Invalid pagination cursor"},"objects":[]}
+
+  def test_get_all_blips_streams(self):
+    user_dict = self.generateUser()
+    song_dict = self.generateSong()
+    for i in range(3):
+      self.createBlip("50.0","50.0",song_dict['id'],user_dict['id'],"testpass")
+
+    rv = self.app.get('/api/blip?stream=1')
+    assert rv.is_streamed
+    assert json.loads(rv.data) == json.loads(self.app.get('/api/blip').data)
+    # streamed responses are never cached
+    assert self.countQueries('/api/blip?stream=1') > 0
+
+  def test_get_blips_with_fields(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    rv_dict = json.loads(self.app.get('/api/blip?id=1&fields=id,latitude,longitude,song_id').data)
+    assert rv_dict['objects'] == [{"id":1, "latitude":50.0, "longitude":50.0, "song_id":song_dict['id']}]
+
+    # only the selected columns are read, without joining song
+    del executed_statements[:]
+    rv_dict = json.loads(self.app.get('/api/blip?fields=song_id').data)
+    assert rv_dict['objects'] == [{"song_id":song_dict['id']}]
+    assert not [statement for statement in executed_statements if 'song' in statement.split('FROM')[-1]]
+
+    rv_dict = json.loads(self.app.get('/api/blip?latitude=50.0&longitude=50.0&fields=id,song').data)
+    assert rv_dict['objects'] == [{"id":1, "song":song_dict}]
+
+    rv = self.app.get('/api/blip?fields=id,password')
+    assert ast.literal_eval(rv.data) == {"meta":{"status":12,"error":"Malformed Parameters"},"objects":[]}
+
+  def test_get_blips_as_msgpack(self):
+    if latitune.msgpack is None:
+      self.skipTest('msgpack not installed')
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    for i in range(2):
+      rv = self.app.get('/api/blip?id=1', headers=[('Accept', 'application/x-msgpack')])
+      assert rv.mimetype == 'application/x-msgpack'
+      assert latitune.msgpack.unpackb(rv.data)['objects'][0]['id'] == 1
+    # JSON stays the default and is cached separately
+    assert json.loads(self.app.get('/api/blip?id=1').data)['objects'][0]['id'] == 1
 
   """ Comment """
 
@@ -413,6 +922,7 @@ class latituneTestCase(unittest.TestCase):
     now = datetime.now().isoformat()
     rv_dict = ast.literal_eval(rv.data)
     rv_dict['objects'][0]['timestamp'] = now
+    blip_dict['comment_count'] = 1
     assert rv_dict == {"meta": {"status"    : 20}, 
                        "objects":
                               [{"id"        : 1,
@@ -449,6 +959,7 @@ class latituneTestCase(unittest.TestCase):
     now = datetime.now().isoformat()
     rv_dict = ast.literal_eval(rv.data)
     rv_dict['objects'][0]['timestamp'] = now
+    blip_dict['comment_count'] = 1
     assert rv_dict == {"meta": {"status"    : 20}, 
                        "objects":
                               [{"id"        : 1,
@@ -471,10 +982,62 @@ class latituneTestCase(unittest.TestCase):
     comment3 = self.createComment(user_dict['id'],"testpass",blip2_dict['id'],"This is a comment part 2")
     comment3_dict = ast.literal_eval(comment3.data)['objects'][0]
 
+    comment1_dict['blip']['comment_count'] = 2
+
     rv = self.app.get('/api/blip/comment?blip_id={0}'.format(blip_dict['id']))
     assert ast.literal_eval(rv.data) == {"meta"   : {"status":20}, 
                                          "objects": [comment2_dict,comment1_dict]}
 
+  def test_get_comment_by_blip_id_paginates(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    for i in range(3):
+      self.createComment(user_dict['id'],"testpass",blip_dict['id'],"comment {0}".format(i))
+
+    rv_dict = ast.literal_eval(self.app.get('/api/blip/comment?blip_id=1&limit=2').data)
+    assert [comment['id'] for comment in rv_dict['objects']] == [3, 2]
+    cursor = rv_dict['meta']['next_cursor']
+
+    rv_dict = ast.literal_eval(self.app.get('/api/blip/comment?blip_id=1&limit=2&cursor={0}'.format(cursor)).data)
+    assert [comment['id'] for comment in rv_dict['objects']] == [1]
+    assert 'next_cursor' not in rv_dict['meta']
+
+  def test_get_comment_by_blip_id_streams(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    for i in range(3):
+      self.createComment(user_dict['id'],"testpass",blip_dict['id'],"comment {0}".format(i))
+
+    rv_dict = json.loads(self.app.get('/api/blip/comment?blip_id=1&stream=1').data)
+    assert rv_dict['meta'] == {"status":20}
+    assert [comment['id'] for comment in rv_dict['objects']] == [3, 2, 1]
+
+  def test_get_comment_by_blip_id_is_cached_until_commented(self):
+    user_dict, song_dict, blip_dict, comment_dict = self.generateComment()
+    url = '/api/blip/comment?blip_id={0}'.format(blip_dict['id'])
+    first = self.app.get(url).data
+    assert self.countQueries(url) == 0
+    assert self.app.get(url).data == first
+
+    self.createComment(user_dict['id'],"testpass",blip_dict['id'],"Another comment")
+    rv_dict = ast.literal_eval(self.app.get(url).data)
+    assert [comment['comment'] for comment in rv_dict['objects']] == ["Another comment", "This is a comment"]
+
+  def test_get_comment_by_blip_id_is_conditional(self):
+    user_dict, song_dict, blip_dict, comment_dict = self.generateComment()
+    url = '/api/blip/comment?blip_id={0}'.format(blip_dict['id'])
+    rv = self.app.get(url)
+    etag          = rv.headers['ETag']
+    last_modified = rv.headers['Last-Modified']
+
+    rv = self.app.get(url, headers=[('If-None-Match', etag)])
+    assert rv.status_code == 304 and rv.data == ''
+    rv = self.app.get(url, headers=[('If-Modified-Since', last_modified)])
+    assert rv.status_code == 304
+
+    # a new comment changes the blip, and with it the validators
+    self.createComment(user_dict['id'],"testpass",blip_dict['id'],"Another comment")
+    rv = self.app.get(url, headers=[('If-None-Match', etag)])
+    assert rv.status_code == 200 and rv.headers['ETag'] != etag
+
   def test_get_comment_with_invalid_data(self):
     rv = self.app.get('/api/blip/comment')
     assert ast.literal_eval(rv.data) == {"meta":{"status":10,"error":"Missing Required Parameters"},"objects":[]}
@@ -552,14 +1115,47 @@ class latituneTestCase(unittest.TestCase):
     self.createFavorite(2,"testpass",1)
     self.createFavorite(3,"testpass",2)
     self.createFavorite(1,"testpass",2)
+    blip_dict['favorite_count'] = 2
+    blip_dict2['favorite_count'] = 2
     rv = self.app.get("/api/blip/favorite?user_id=1")
     assert ast.literal_eval(rv.data) == {"meta":{"status":20},
                                          "objects":[blip_dict,blip_dict2]}
 
+  def test_get_favorites_issues_fixed_number_of_queries(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    self.createFavorite(1,"testpass",1)
+    by_user = self.countQueries("/api/blip/favorite?user_id=1")
+    by_blip = self.countQueries("/api/blip/favorite?blip_id=1")
+
+    for title in ["Waterloo Sunset", "Lola", "Victoria"]:
+      song = self.generateSong(title=title)
+      blip = ast.literal_eval(self.createBlip(50,50,song['id'],1,"testpass").data)['objects'][0]
+      self.createFavorite(1,"testpass",blip['id'])
+    self.generateUser(username="ben2",email="ben2@gmail.com")
+    self.createFavorite(2,"testpass",1)
+    assert self.countQueries("/api/blip/favorite?user_id=1") == by_user
+    assert self.countQueries("/api/blip/favorite?blip_id=1") == by_blip
+
+  def test_get_favorites_is_cached_until_favorited(self):
+    latitune.response_cache.backend = latitune.SharedBackend(latitune.DictClient())
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    self.app.get("/api/blip/favorite?user_id=1")
+    assert self.countQueries("/api/blip/favorite?user_id=1") == 0
+
+    self.createFavorite(1,"testpass",1)
+    blip_dict['favorite_count'] = 1
+    rv = self.app.get("/api/blip/favorite?user_id=1")
+    assert ast.literal_eval(rv.data)['objects'] == [blip_dict]
+
+    self.app.delete("/api/blip/favorite?user_id=1&blip_id=1&password=testpass")
+    rv = self.app.get("/api/blip/favorite?user_id=1")
+    assert ast.literal_eval(rv.data)['objects'] == []
+
   def test_refavorite_does_nothing(self):
     user_dict, song_dict, blip_dict = self.generateBlip()
     self.createFavorite(1,"testpass",1)
     self.createFavorite(1,"testpass",1)
+    blip_dict['favorite_count'] = 1
     rv = self.app.get("/api/blip/favorite?user_id=1")
     rv_dict = ast.literal_eval(rv.data)
     assert rv_dict == {"meta": {"status":20},
@@ -575,6 +1171,111 @@ class latituneTestCase(unittest.TestCase):
     assert ast.literal_eval(rv.data) == {"meta":{"status":20},
                                          "objects":[]}
 
+  def test_blip_counts_favorites_and_comments(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    self.generateUser(username="ben2",email="ben2@gmail.com")
+    self.createFavorite(1,"testpass",1)
+    self.createFavorite(2,"testpass",1)
+    self.createFavorite(2,"testpass",1)
+    self.createComment(1,"testpass",1,"This is a comment")
+    rv_dict = ast.literal_eval(self.app.get('/api/blip?id=1').data)
+    assert (rv_dict['objects'][0]['favorite_count'], rv_dict['objects'][0]['comment_count']) == (2, 1)
+
+    self.app.delete("/api/blip/favorite?user_id=2&blip_id=1&password=testpass")
+    rv_dict = ast.literal_eval(self.app.get('/api/blip?id=1').data)
+    assert (rv_dict['objects'][0]['favorite_count'], rv_dict['objects'][0]['comment_count']) == (1, 1)
+
+  def test_hot_score_decays_and_withdraws(self):
+    then  = datetime(2013, 6, 1)
+    score = latitune.scoring.initial_score(then)
+    later = latitune.scoring.initial_score(then + timedelta(seconds=latitune.scoring.HOT_DECAY_SECONDS))
+    assert abs(later - score - 1) < 1e-9
+    bumped = latitune.scoring.add_event(score, latitune.scoring.FAVORITE_WEIGHT, then)
+    assert abs(bumped - score - math.log(3)) < 1e-9
+    assert abs(latitune.scoring.remove_event(bumped, latitune.scoring.FAVORITE_WEIGHT, then, score) - score) < 1e-9
+    assert latitune.scoring.remove_event(score, latitune.scoring.FAVORITE_WEIGHT, then, score) == score
+
+  def test_get_hot_blips_near_point(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    self.createBlip("50.01","50.01",song_dict['id'],user_dict['id'],"testpass")
+    self.createBlip("50.02","50.02",song_dict['id'],user_dict['id'],"testpass")
+    self.createBlip("10.0","10.0",song_dict['id'],user_dict['id'],"testpass")
+    url = '/api/blip?latitude=50.0&longitude=50.0&sort=hot'
+    rv_dict = ast.literal_eval(self.app.get(url).data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [3, 2, 1]
+
+    # the index is kept current by the write paths, without reloading cells
+    self.generateUser(username="ben2",email="ben2@gmail.com")
+    self.createFavorite(1,"testpass",1)
+    self.createFavorite(2,"testpass",1)
+    self.createComment(1,"testpass",2,"This is a comment")
+    assert self.countQueries(url) == 2
+    rv_dict = ast.literal_eval(self.app.get(url).data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [1, 2, 3]
+
+    self.app.delete("/api/blip/favorite?user_id=2&blip_id=1&password=testpass")
+    self.app.delete("/api/blip/favorite?user_id=1&blip_id=1&password=testpass")
+    rv_dict = ast.literal_eval(self.app.get(url + '&limit=2').data)
+    assert [blip['id'] for blip in rv_dict['objects']] == [2, 3]
+
+  def test_subscription_index_matches_regions(self):
+    broker  = latitune.LocalBroker()
+    boston  = broker.subscribe(42.5, 42.2, -70.9, -71.2)
+    pacific = broker.subscribe(10.0, -10.0, -170.0, 170.0)
+    world   = broker.subscribe(90.0, -90.0, 180.0, -180.0)
+    broker.publish('blip', 42.36, -71.06, {"id":1})
+    broker.publish('blip', 0.0, 179.5, {"id":2})
+    assert (boston.messages.qsize(), pacific.messages.qsize(), world.messages.qsize()) == (1, 1, 2)
+    assert boston.messages.get() == 'event: blip\ndata: {"id": 1}\n\n'
+
+    broker.unsubscribe(boston)
+    broker.publish('blip', 42.36, -71.06, {"id":3})
+    assert boston.messages.empty()
+
+  def test_new_activity_is_pushed_to_subscribers(self):
+    latitune.app.config['WORKER_CLASS'] = 'gevent'
+    try:
+      rv = self.app.get('/api/blip/stream')
+    finally:
+      latitune.app.config['WORKER_CLASS'] = None
+    assert ast.literal_eval(rv.data)['meta']['status'] == 10
+    near = latitune.push_broker.subscribe(51.0, 49.0, 51.0, 49.0)
+    far  = latitune.push_broker.subscribe(11.0, 9.0, 11.0, 9.0)
+    try:
+      user_dict, song_dict, blip_dict = self.generateBlip()
+      self.createComment(1,"testpass",1,"This is a comment")
+      self.createFavorite(1,"testpass",1)
+      events = []
+      while not near.messages.empty():
+        events.append(near.messages.get())
+      assert [event.split('\n')[0] for event in events] == ['event: blip', 'event: comment', 'event: favorite']
+      assert json.loads(events[0].split('data: ')[1]) == blip_dict
+      assert far.messages.empty()
+    finally:
+      latitune.push_broker.unsubscribe(near)
+      latitune.push_broker.unsubscribe(far)
+
+  def test_streams_are_refused_without_async_workers(self):
+    for worker_class in ['sync', None]:
+      latitune.app.config['WORKER_CLASS'] = worker_class
+      try:
+        rv = self.app.get('/api/blip/stream?north=1&south=0&east=1&west=0')
+      finally:
+        latitune.app.config['WORKER_CLASS'] = None
+      assert rv.status_code == 503
+      assert json.loads(rv.data)['meta']['status'] == 13
+
+  def test_relayed_events_reach_local_subscribers(self):
+    broker = latitune.PostgresBroker(latitune.db.engine)
+    near   = push.Subscription(51.0, 49.0, 51.0, 49.0)
+    broker.index.add(near)
+    broker.deliver(push.notification('blip', 50.0, 50.0, {'id':1}))
+    broker.deliver(push.notification('blip', 10.0, 10.0, {'id':2}))
+    assert near.messages.get_nowait() == 'event: blip\ndata: {"id": 1}\n\n'
+    assert near.messages.empty()
+    large = json.loads(push.notification('comment', 50.0, 50.0, {'id':3, 'comment':'x' * 10000}))
+    assert large['obj'] == {'id':3}
+
   def test_delete_favorite_with_invalid_data(self):
     rv = self.app.delete("/api/blip/favorite")
     assert ast.literal_eval(rv.data) == {"meta":{"status":10,"error":"Missing Required Parameters"},"objects":[]}
@@ -591,5 +1292,154 @@ class latituneTestCase(unittest.TestCase):
     assert ast.literal_eval(rv.data) == {"meta": {"status": 32, "error": "Invalid Authentication"}, "objects": []}
 
 
+  """
+  Feed Tests
+  """
+
+  def generateGroup(self, members):
+    """A group created by the first of members (user dicts) and joined by the rest"""
+    rv = self.app.put("/api/group", data=dict(user_id=members[0]['id'], password="testpass"))
+    group_id = json.loads(rv.data)['objects'][0]['id']
+    for member in members[1:]:
+      self.app.put("/api/group/member", data=dict(user_id=member['id'], group_id=group_id, password="testpass"))
+    return group_id
+
+  def createPost(self, user_id, group_id, url, tags=""):
+    return self.app.put("/api/post", data=dict(user_id=user_id, group_id=group_id, password="testpass",
+                                               kind="song", url=url, tags=tags))
+
+  def test_posts_fan_out_to_member_feeds(self):
+    ben   = self.generateUser()
+    alice = self.generateUser(username="alice", email="alice@example.com")
+    carol = self.generateUser(username="carol", email="carol@example.com")
+    group_id = self.generateGroup([ben, alice])
+    for i in range(3):
+      assert json.loads(self.createPost(ben['id'], group_id, "http://example.com/%d" % i).data)['meta']['status'] == 20
+    assert latitune.TimelineEntry.query.filter_by(user_id=alice['id']).count() == 3
+    assert latitune.TimelineEntry.query.filter_by(user_id=carol['id']).count() == 0
+
+    rv   = json.loads(self.app.get("/api/feed?user_id=%d&password=testpass&limit=2" % alice['id']).data)
+    rest = json.loads(self.app.get("/api/feed?user_id=%d&password=testpass&cursor=%s" %
+                                   (alice['id'], rv['meta']['next_cursor'])).data)
+    assert [post['url'] for post in rv['objects'] + rest['objects']] == \
+      ["http://example.com/2", "http://example.com/1", "http://example.com/0"]
+    assert 'next_cursor' not in rest['meta']
+
+    # joining backfills the new member's timeline
+    self.app.put("/api/group/member", data=dict(user_id=carol['id'], group_id=group_id, password="testpass"))
+    rv = json.loads(self.app.get("/api/feed?user_id=%d&password=testpass" % carol['id']).data)
+    assert len(rv['objects']) == 3
+
+  def test_post_requires_membership(self):
+    ben   = self.generateUser()
+    alice = self.generateUser(username="alice", email="alice@example.com")
+    group_id = self.generateGroup([ben])
+    rv = self.createPost(alice['id'], group_id, "http://example.com")
+    assert json.loads(rv.data)['meta']['status'] == 81
+    rv = self.createPost(alice['id'], group_id + 1, "http://example.com")
+    assert json.loads(rv.data)['meta']['status'] == 80
+
+  def test_large_groups_fan_out_on_read(self):
+    latitune.timelines.fanout_limit = 1
+    ben   = self.generateUser()
+    alice = self.generateUser(username="alice", email="alice@example.com")
+    group_id = self.generateGroup([ben])
+    self.createPost(ben['id'], group_id, "http://example.com/0")
+    self.app.put("/api/group/member", data=dict(user_id=alice['id'], group_id=group_id, password="testpass"))
+    assert not latitune.Group.query.get(group_id).fanout
+    self.createPost(ben['id'], group_id, "http://example.com/1")
+    assert latitune.TimelineEntry.query.filter_by(user_id=alice['id']).count() == 0
+    rv = json.loads(self.app.get("/api/feed?user_id=%d&password=testpass" % ben['id']).data)
+    assert [post['url'] for post in rv['objects']] == ["http://example.com/1", "http://example.com/0"]
+
+  def test_timelines_are_trimmed(self):
+    latitune.timelines.length    = 2
+    latitune.timelines.trim_rate = 1
+    ben = self.generateUser()
+    group_id = self.generateGroup([ben])
+    for i in range(4):
+      self.createPost(ben['id'], group_id, "http://example.com/%d" % i)
+    assert latitune.TimelineEntry.query.filter_by(user_id=ben['id']).count() == 2
+
+
+  def test_search_posts_by_tags(self):
+    ben = self.generateUser()
+    group_id = self.generateGroup([ben])
+    self.createPost(ben['id'], group_id, "http://example.com/0", "rock,live")
+    self.createPost(ben['id'], group_id, "http://example.com/1", "rock")
+    self.createPost(ben['id'], group_id, "http://example.com/2", "jazz, live")
+
+    rv = json.loads(self.app.get("/api/post?tags=rock,live").data)
+    assert [post['url'] for post in rv['objects']] == ["http://example.com/0"]
+    assert sorted(rv['objects'][0]['tags']) == ["live", "rock"]
+    assert rv['meta']['total'] == 1
+    assert rv['meta']['counts'] == {"rock":2, "live":2}
+
+    rv = json.loads(self.app.get("/api/post?tags=rock,jazz&match=any&limit=2").data)
+    assert [post['url'] for post in rv['objects']] == ["http://example.com/2", "http://example.com/1"]
+    assert rv['meta']['total'] == 3
+    rv = json.loads(self.app.get("/api/post?tags=rock,jazz&match=any&cursor=" + rv['meta']['next_cursor']).data)
+    assert [post['url'] for post in rv['objects']] == ["http://example.com/0"]
+
+    rv = json.loads(self.app.get("/api/post?tags=rock,blues").data)
+    assert rv['objects'] == [] and rv['meta']['counts'] == {"rock":2, "blues":0}
+
+    # new posts invalidate cached searches of their tags
+    self.createPost(ben['id'], group_id, "http://example.com/3", "blues,rock")
+    rv = json.loads(self.app.get("/api/post?tags=rock,blues").data)
+    assert [post['url'] for post in rv['objects']] == ["http://example.com/3"]
+
+
+  """
+  Search Tests
+  """
+
+  def test_tokenize(self):
+    assert latitune.search.tokenize(u"Big  Sky, big sky!") == [u"big", u"sky"]
+    assert latitune.search.tokenize(None) == []
+
+  def test_search_matches_prefixes_and_ranks(self):
+    self.generateSong(artist="The Kinks", title="Big Sky")
+    self.generateSong(artist="Big Star", title="Thirteen")
+    self.generateSong(artist="The Kinks", title="Waterloo Sunset")
+    rv = json.loads(self.app.get("/api/search?q=bi&kinds=song").data)
+    # a title match outranks an artist match
+    assert [hit['song']['title'] for hit in rv['objects']] == ["Big Sky", "Thirteen"]
+    rv = json.loads(self.app.get("/api/search?q=kinks%20wat").data)
+    assert [(hit['kind'], hit['song']['title']) for hit in rv['objects']] == [("song", "Waterloo Sunset")]
+    rv = json.loads(self.app.get("/api/search?q=b&kinds=song").data)
+    assert rv['objects'] == []
+
+  def test_search_covers_users_and_comments(self):
+    user_dict, song_dict, blip_dict = self.generateBlip()
+    self.app.put("/api/blip/comment", data=dict(user_id=user_dict['id'], blip_id=blip_dict['id'],
+                                                password="testpass", comment="What a lovely tune"))
+    rv = json.loads(self.app.get("/api/search?q=lovely&kinds=comment,user").data)
+    assert [hit['comment']['comment'] for hit in rv['objects']] == ["What a lovely tune"]
+    rv = json.loads(self.app.get("/api/search?q=be&kinds=comment,user").data)
+    assert [hit['user']['name'] for hit in rv['objects']] == ["ben"]
+    rv = json.loads(self.app.get("/api/search?q=be&kinds=blip").data)
+    assert rv['meta']['status'] == 12
+
+  def test_search_results_follow_song_and_blip_changes(self):
+    provider = FakeProvider({("The Kinks","Big Sky"):"abc123"})
+    latitune.Song.provider = provider
+    try:
+      user_dict, song_dict, blip_dict = self.generateBlip()
+      self.createComment(user_dict['id'], "testpass", blip_dict['id'], "What a lovely tune")
+      rv = json.loads(self.app.get("/api/search?q=big&kinds=song").data)
+      assert rv['objects'][0]['song']['provider_song_id'] == ""
+      rv = json.loads(self.app.get("/api/search?q=lovely&kinds=comment").data)
+      assert rv['objects'][0]['comment']['blip']['favorite_count'] == 0
+      latitune.song_resolver.drain()
+      self.createFavorite(user_dict['id'], "testpass", blip_dict['id'])
+    finally:
+      latitune.Song.provider = latitune.providers.youtube
+    rv = json.loads(self.app.get("/api/search?q=big&kinds=song").data)
+    assert rv['objects'][0]['song']['provider_song_id'] == "abc123"
+    rv = json.loads(self.app.get("/api/search?q=lovely&kinds=comment").data)
+    assert rv['objects'][0]['comment']['blip']['favorite_count'] == 1
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -4,22 +4,25 @@
 
 import os
 import sys
+import geo
+import scoring
+import providers
 from settings import *
+from instrumentation import timed
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import Table, Column, Integer, ForeignKey
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.exc import IntegrityError
 
-Base = declarative_base()
-
-groups_to_users_table = Table('groups_to_users', Base.metadata,
-    Column('group_id', Integer, ForeignKey('group.id')),
-    Column('user_id',  Integer, ForeignKey('user.id'))
+groups_to_users_table = db.Table('groups_to_users', db.metadata,
+    db.Column('group_id', db.Integer, db.ForeignKey('group.id'), primary_key = True),
+    db.Column('user_id',  db.Integer, db.ForeignKey('user.id'), primary_key = True, index = True)
 )
 
-posts_to_tags_table = Table('posts_to_tags', Base.metadata,
-    Column('post_id', Integer, ForeignKey('post.id')),
-    Column('tag_id',  Integer, ForeignKey('tag.id'))
+posts_to_tags_table = db.Table('posts_to_tags', db.metadata,
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key = True),
+    db.Column('tag_id',  db.Integer, db.ForeignKey('tag.id'), primary_key = True),
+    # the postings of a tag, read without touching the table
+    db.Index('ix_posts_to_tags_tag_post', 'tag_id', 'post_id')
 )
 
 
@@ -44,6 +47,7 @@ class User(db.Model):
     return check_password_hash(self.pw_hash, password)
 
   @property
+  @timed('serialize')
   def serialize(self):
     """Return object data in easily serializeable format"""
     return {
@@ -53,35 +57,69 @@ class User(db.Model):
     }
 
 class Post(db.Model):
-  __tablename__ = 'post'
+  __tablename__  = 'post'
+  __table_args__ = (db.Index('ix_post_group_timestamp', 'group_id', 'timestamp', 'id'),)
 
   id         = db.Column(db.Integer, primary_key = True)
   kind       = db.Column(db.String(80))
   url        = db.Column(db.String(120))
-  timestamp = db.Column(db.DateTime, default=datetime.now)
+  timestamp  = db.Column(db.DateTime, default=datetime.now)
   group_id   = db.Column(db.Integer, db.ForeignKey('group.id'))
   user_id    = db.Column(db.Integer, db.ForeignKey('user.id'))
   tags       = db.relationship("Tag", secondary = posts_to_tags_table, backref = "post")
 
   def __init__(self, kind, url, group, user, tags):
-    self.kind  = kind
-    self.url   = url
-    self.group = group
-    self.user  = user
-    self.tags  = tags
+    self.kind      = kind
+    self.url       = url
+    self.group     = group
+    self.user      = user
+    self.tags      = tags
+    self.timestamp = datetime.now()
+
+  @classmethod
+  def eager(cls):
+    """Query that loads everything serialize touches up front"""
+    return cls.query.options(db.joinedload('user'), db.subqueryload('tags'))
+
+  @classmethod
+  def by_ids(cls, ids):
+    """Posts with the given ids, in the order of ids"""
+    if not ids:
+      return []
+    posts = dict((post.id, post) for post in cls.eager().filter(cls.id.in_(ids)))
+    return [posts[p_id] for p_id in ids if p_id in posts]
+
+  @classmethod
+  def tagged(cls, tag_ids, match_all=True):
+    """
+    Query for the (timestamp, id) of the posts with all (or any) of tag_ids,
+    and the number of them. Both come from the postings of those tags alone.
+    """
+    matching = (db.session.query(posts_to_tags_table.c.post_id)
+                          .filter(posts_to_tags_table.c.tag_id.in_(tag_ids))
+                          .group_by(posts_to_tags_table.c.post_id))
+    if match_all:
+      matching = matching.having(db.func.count(posts_to_tags_table.c.tag_id) == len(set(tag_ids)))
+    postings = matching.subquery()
+    return (db.session.query(cls.timestamp, cls.id).join(postings, postings.c.post_id == cls.id),
+            matching.count())
+
+  @classmethod
+  def in_groups(cls, group_ids):
+    """Query for the (timestamp, id) of the posts of groups"""
+    return db.session.query(cls.timestamp, cls.id).filter(cls.group_id.in_(group_ids))
 
   @property
+  @timed('serialize')
   def serialize(self):
-    group = Group.query.filter_by(id=self.group_id).first()
-    user  = Group.query.filter_by(id=self.user_id).first()
     return {
       'id'         : self.id,
       'kind'       : self.kind,
       'url'        : self.url,
-      'date_added' : self.date_added,
-      'group'      : group.serialize,
-      'user'       : user.serialize,
-      'tags'       : str(self.tags)
+      'date_added' : self.timestamp.isoformat(),
+      'group_id'   : self.group_id,
+      'user'       : self.user.serialize,
+      'tags'       : [tag.name for tag in self.tags]
     }
 
 
@@ -89,50 +127,523 @@ class Group(db.Model):
   __tablename__ = 'group'
 
   id        = db.Column(db.Integer, primary_key = True)
+  # False once the group outgrows FANOUT_LIMIT; its posts are then merged
+  # into feeds when read instead of being copied to every member's timeline
+  fanout    = db.Column(db.Boolean, default = True, nullable = False)
   users     = db.relationship("User", secondary = groups_to_users_table, backref = "group")
   posts     = db.relationship("Post", backref = "group")
 
   def __init__(self, users, posts):
-    self.users = users
-    self.posts = posts
+    self.users  = users
+    self.posts  = posts
+    self.fanout = True
+
+  @classmethod
+  def member_ids(cls, group_id):
+    return [u_id for u_id, in db.session.query(groups_to_users_table.c.user_id)
+                                        .filter(groups_to_users_table.c.group_id == group_id)]
+
+  @classmethod
+  def member_count(cls, group_id):
+    return (db.session.query(db.func.count(groups_to_users_table.c.user_id))
+                      .filter(groups_to_users_table.c.group_id == group_id).scalar())
+
+  @classmethod
+  def is_member(cls, group_id, user_id):
+    return db.session.query(groups_to_users_table.c.user_id).filter(
+      groups_to_users_table.c.group_id == group_id,
+      groups_to_users_table.c.user_id == user_id).first() is not None
+
+  @classmethod
+  def pulled_ids(cls, user_id):
+    """Ids of the groups of a user whose posts are not fanned out"""
+    return [g_id for g_id, in db.session.query(cls.id)
+                                        .filter(cls.id == groups_to_users_table.c.group_id)
+                                        .filter(groups_to_users_table.c.user_id == user_id)
+                                        .filter(cls.fanout == False)]
+
+  @classmethod
+  def eager(cls):
+    """Query that loads everything serialize touches up front"""
+    return cls.query.options(db.subqueryload('users'),
+                             db.subqueryload_all('posts.user'),
+                             db.subqueryload_all('posts.tags'))
 
   @property
+  @timed('serialize')
   def serialize(self):
-    song = Song.query.filter_by(id=self.song_id).first()
     return {
       'id' : self.id,
-      'users' : [user.serialize for user in users],
-      'posts' : [post.serialize for post in posts]
+      'users' : [user.serialize for user in self.users],
+      'posts' : [post.serialize for post in self.posts]
     }
 
 class Tag(db.Model):
   __tablename__ = 'tag'
 
   id = db.Column(db.Integer, primary_key = True)
-  name = db.Column(db.String(20))
-
-# class Comment(db.Model):
-#   __tablename__ = "comment"
-#
-#   id        = db.Column(db.Integer, primary_key = True)
-#   blip_id   = db.Column(db.Integer, db.ForeignKey('blip.id'))
-#   user_id   = db.Column(db.Integer, db.ForeignKey('user.id'))
-#   comment   = db.Column(db.Text)
-#   timestamp = db.Column(db.DateTime, default=datetime.now)
-#
-#   def __init__(self, user_id,blip_id,comment):
-#     self.user_id = user_id
-#     self.blip_id = blip_id
-#     self.comment = comment
-#
-#   @property
-#   def serialize(self):
-#     blip = Blip.query.filter_by(id=self.blip_id).first()
-#     return {
-#       'id'       : self.id,
-#       'blip'     : blip.serialize,
-#       'comment'  : self.comment,
-#       'user_id'  : self.user_id,
-#       'timestamp': self.timestamp.isoformat()
-#     }
+  name = db.Column(db.String(20), unique = True)
+
+  @classmethod
+  def postings(cls, names):
+    """(id, name, number of posts) of the tags among names that have posts"""
+    return (db.session.query(cls.id, cls.name, db.func.count(posts_to_tags_table.c.post_id))
+                      .filter(cls.id == posts_to_tags_table.c.tag_id)
+                      .filter(cls.name.in_(names))
+                      .group_by(cls.id, cls.name).all())
+
+class TimelineEntry(db.Model):
+  """
+  A post copied into the timeline of a member of its group when it was
+  written. A page of a feed is one range read of (user_id, timestamp, post_id).
+  """
+  __tablename__  = 'timeline_entry'
+  __table_args__ = (db.Index('ix_timeline_entry_user_timestamp', 'user_id', 'timestamp', 'post_id'),)
+
+  id        = db.Column(db.Integer, primary_key = True)
+  user_id   = db.Column(db.Integer, db.ForeignKey('user.id'), nullable = False)
+  post_id   = db.Column(db.Integer, db.ForeignKey('post.id'), nullable = False)
+  timestamp = db.Column(db.DateTime, nullable = False)
+
+  @classmethod
+  def fan_out(cls, post, user_ids):
+    """Add post to the timelines of user_ids, in one statement"""
+    if user_ids:
+      db.session.execute(cls.__table__.insert(),
+                         [{'user_id':u_id, 'post_id':post.id, 'timestamp':post.timestamp}
+                          for u_id in user_ids])
+
+  @classmethod
+  def trim(cls, user_id, length):
+    """Drop the entries of a timeline past its length newest"""
+    cut = (db.session.query(cls.timestamp, cls.post_id).filter_by(user_id=user_id)
+                     .order_by(cls.timestamp.desc(), cls.post_id.desc())
+                     .offset(length).first())
+    if cut is not None:
+      db.session.query(cls).filter(cls.user_id == user_id).filter(db.or_(
+        cls.timestamp < cut.timestamp,
+        db.and_(cls.timestamp == cut.timestamp, cls.post_id <= cut.post_id))
+      ).delete(synchronize_session=False)
+
+PROVIDER_PENDING  = "pending"
+PROVIDER_RESOLVED = "resolved"
+PROVIDER_FAILED   = "failed"
+
+class Song(db.Model):
+  __tablename__ = 'song'
+
+  # looks up provider_song_id; swapped for a fake in tests
+  provider = providers.youtube
+
+  id               = db.Column(db.Integer, primary_key = True)
+  artist           = db.Column(db.String(80))
+  title            = db.Column(db.String(80))
+  album            = db.Column(db.String(80))
+  provider_key     = db.Column(db.String(80))
+  provider_song_id = db.Column(db.String(80))
+  provider_state   = db.Column(db.String(20), index = True)
+  # when a resolver last claimed the song (see SongResolver.claim)
+  provider_claimed = db.Column(db.DateTime)
+  # providers.normalize(artist, title); one song per key
+  normalized_key   = db.Column(db.String(255), unique = True)
+
+  def __init__(self, artist, title, album="", resolve=True):
+    """With resolve=False the provider lookup is left to a SongResolver"""
+    self.artist         = artist
+    self.title          = title
+    self.album          = album
+    self.normalized_key = providers.normalize(artist, title)
+    self.provider_key   = self.provider.key
+    if resolve:
+      self.provider_song_id = self.provider.lookup(artist, title)
+      self.provider_state   = PROVIDER_RESOLVED
+    else:
+      self.provider_song_id = ""
+      self.provider_state   = PROVIDER_PENDING
+
+  def resolved(self, provider_song_id):
+    self.provider_song_id = provider_song_id
+    self.provider_state   = PROVIDER_RESOLVED
+
+  @classmethod
+  def upsert(cls, song):
+    """
+    Store a new song unless one with its normalized key exists, safely under
+    concurrent requests; returns (stored song, whether it was inserted). It
+    flushes but leaves committing to the caller, and must come before any
+    other change of the transaction: the fallback rolls it back on conflict.
+    """
+    values = dict((column.name, getattr(song, column.name))
+                  for column in cls.__table__.columns if column.name != 'id')
+    if db.engine.name == 'postgresql':
+      # one statement either way; the no-op update makes RETURNING yield the
+      # existing row, and xmax is 0 only for a row this statement inserted
+      return db.session.query(cls, db.literal_column('inserted')).from_statement(
+        'INSERT INTO song (%s) VALUES (%s) '
+        'ON CONFLICT (normalized_key) DO UPDATE SET normalized_key = EXCLUDED.normalized_key '
+        'RETURNING song.*, xmax = 0 AS inserted' %
+        (', '.join(values), ', '.join(':' + name for name in values))).params(**values).one()
+    db.session.add(song)
+    try:
+      db.session.flush()
+      return song, True
+    except IntegrityError:
+      db.session.rollback()
+      return cls.query.filter_by(normalized_key=song.normalized_key).one(), False
+
+  @classmethod
+  def merge_duplicates(cls):
+    """
+    Fill in missing normalized keys, then fold every group of songs sharing
+    one into its oldest song: their blips move to it and the rest are deleted.
+    Returns the number of songs deleted. For rows stored before songs were
+    keyed; the unique index can only be created once this has run.
+    """
+    keep       = {}
+    duplicates = []
+    stale      = []
+    for s_id, artist, title, stored in (db.session.query(cls.id, cls.artist, cls.title, cls.normalized_key)
+                                                  .order_by(cls.id)):
+      key = providers.normalize(artist or u'', title or u'')
+      if key in keep:
+        duplicates.append((s_id, keep[key]))
+        continue
+      keep[key] = s_id
+      if stored != key:
+        stale.append((s_id, key))
+    # duplicates go first, as one of them may hold a key its song is given
+    for s_id, kept_id in duplicates:
+      Blip.query.filter_by(song_id=s_id).update({'song_id':kept_id, 'modified':datetime.now()},
+                                                synchronize_session=False)
+      SearchTerm.query.filter_by(kind='song', object_id=s_id).delete(synchronize_session=False)
+      cls.query.filter_by(id=s_id).delete(synchronize_session=False)
+    for s_id, key in stale:
+      cls.query.filter_by(id=s_id).update({'normalized_key':key}, synchronize_session=False)
+    db.session.commit()
+    return len(duplicates)
+
+  @property
+  @timed('serialize')
+  def serialize(self):
+    return {
+      'id'               : self.id,
+      'artist'           : self.artist,
+      'title'            : self.title,
+      'album'            : self.album,
+      'provider_key'     : self.provider_key,
+      'provider_song_id' : self.provider_song_id,
+      'provider_state'   : self.provider_state
+    }
+
+class ProviderLookup(db.Model):
+  """Persistent tier of the provider lookup cache (see resolver.ProviderCache)"""
+  __tablename__ = 'provider_lookup'
+
+  provider_key     = db.Column(db.String(80), primary_key = True)
+  key              = db.Column(db.String(255), primary_key = True)
+  provider_song_id = db.Column(db.String(80))
+  resolved_at      = db.Column(db.DateTime, default=datetime.now)
+
+  def __init__(self, provider_key, key, provider_song_id):
+    self.provider_key     = provider_key
+    self.key              = key
+    self.provider_song_id = provider_song_id
+    self.resolved_at      = datetime.now()
+
+def rank_by_distance(lat, lng, rows):
+  """(distance, id) for (id, latitude, longitude) rows, closest first"""
+  return sorted((geo.distance(lat, lng, b_lat, b_lng), b_id) for b_id, b_lat, b_lng in rows)
+
+class Blip(db.Model):
+  __tablename__ = 'blip'
+
+  id        = db.Column(db.Integer, primary_key = True)
+  song_id   = db.Column(db.Integer, db.ForeignKey('song.id'))
+  user_id   = db.Column(db.Integer, db.ForeignKey('user.id'))
+  longitude = db.Column(db.Float)
+  latitude  = db.Column(db.Float)
+  geohash   = db.Column(db.String(geo.GEOHASH_PRECISION), index = True)
+  timestamp = db.Column(db.DateTime, default=datetime.now)
+  song      = db.relationship("Song")
+
+  # maintained by the favorite and comment write paths in the same transaction
+  favorite_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+  comment_count  = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+  # log space hotness (see scoring.py), folded in by the same write paths
+  hot_score      = db.Column(db.Float, index = True)
+  # bumped by every write that changes what serialize returns, including
+  # counter updates; validators for conditional GETs are built from it
+  modified       = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, index = True)
+
+  def __init__(self, song_id, user_id, longitude, latitude):
+    self.song_id        = song_id
+    self.user_id        = user_id
+    self.longitude      = float(longitude)
+    self.latitude       = float(latitude)
+    self.geohash        = geo.encode(self.latitude, self.longitude)
+    self.timestamp      = datetime.now()
+    self.favorite_count = 0
+    self.comment_count  = 0
+    self.hot_score      = scoring.initial_score(self.timestamp)
+
+  @classmethod
+  def increment(cls, blip_id, counter, amount=1):
+    """Atomically add amount to a counter column; commit with the triggering write"""
+    cls.query.filter_by(id=blip_id).update({counter: getattr(cls, counter) + amount},
+                                           synchronize_session=False)
+
+  @classmethod
+  def recount(cls):
+    """
+    Set every favorite_count and comment_count from the favorite and comment
+    tables. Returns the number of blips corrected. For blips stored before
+    the counters were kept, which read 0.
+    """
+    favorites = db.select([db.func.count(Favorite.id)]).where(Favorite.blip_id == cls.id).as_scalar()
+    comments  = db.select([db.func.count(Comment.id)]).where(Comment.blip_id == cls.id).as_scalar()
+    corrected = (cls.query.filter(db.or_(cls.favorite_count != favorites, cls.comment_count != comments))
+                          .update({'favorite_count':favorites, 'comment_count':comments,
+                                   'modified':datetime.now()}, synchronize_session=False))
+    db.session.commit()
+    return corrected
+
+  @classmethod
+  def backfill_geohashes(cls):
+    """
+    Fill in geohash for blips missing one. Returns the number of blips
+    updated. For blips stored before the column was added, which every
+    location query skips until they have one.
+    """
+    missing = db.session.query(cls.id, cls.latitude, cls.longitude).filter(cls.geohash == None).all()
+    for b_id, lat, lng in missing:
+      cls.query.filter_by(id=b_id).update({'geohash':geo.encode(lat, lng)}, synchronize_session=False)
+    db.session.commit()
+    return len(missing)
+
+  @classmethod
+  def record_event(cls, blip_id, weight, when=None, withdraw=False):
+    """
+    Fold a favorite or comment of weight at when into hot_score, or withdraw
+    one, under a row lock; commit with the triggering write. Returns
+    (geohash, id, hot_score) for HotIndex.update once committed.
+    """
+    blip = cls.query.with_lockmode('update').populate_existing().filter_by(id=blip_id).first()
+    when  = when or datetime.now()
+    floor = scoring.initial_score(blip.timestamp)
+    score = floor if blip.hot_score is None else blip.hot_score
+    if withdraw:
+      blip.hot_score = scoring.remove_event(score, weight, when, floor)
+    else:
+      blip.hot_score = scoring.add_event(score, weight, when)
+    return blip.geohash, blip.id, blip.hot_score
 
+  @classmethod
+  def touch_song(cls, song_id):
+    """Mark the blips embedding a song as modified; commit with the song's update"""
+    cls.query.filter_by(song_id=song_id).update({'modified': datetime.now()}, synchronize_session=False)
+
+  @classmethod
+  def version_query(cls):
+    """Query for (newest id, newest modified time); restrict it like any blip query"""
+    return db.session.query(db.func.max(cls.id), db.func.max(cls.modified))
+
+  @classmethod
+  def version(cls, ids=None):
+    """(newest id, newest modified time) among ids, or among every blip when None"""
+    if ids is not None and not ids:
+      return None, None
+    query = cls.version_query()
+    if ids is not None:
+      query = query.filter(cls.id.in_(ids))
+    return tuple(query.one())
+
+  @classmethod
+  def hottest(cls, cell, limit):
+    """(hot_score, id) of the limit hottest blips in a geohash cell"""
+    return (db.session.query(cls.hot_score, cls.id)
+                      .filter(cls.geohash.between(cell, cell + '~'))
+                      .filter(cls.hot_score != None)
+                      .order_by(cls.hot_score.desc())
+                      .limit(limit).all())
+
+  @classmethod
+  def in_bounds(cls, query, north, south, east, west):
+    """Restrict a blip query to a bounding box, prefiltered on geohash cells"""
+    query = query.filter(cls.latitude.between(south, north))
+    if east >= west:
+      query = query.filter(cls.longitude.between(west, east))
+    else:
+      query = query.filter(db.or_(cls.longitude >= west, cls.longitude <= east))
+    cells = geo.cover(north, south, east, west)
+    if cells:
+      query = query.filter(db.or_(*[cls.geohash.between(cell, cell + '~') for cell in cells]))
+    return query
+
+  @classmethod
+  def coordinates(cls):
+    return db.session.query(cls.id, cls.latitude, cls.longitude)
+
+  @classmethod
+  def coordinates_within(cls, lat, lng, radius):
+    """(id, latitude, longitude) of every blip within radius miles"""
+    north, south, east, west = geo.bounding_box(lat, lng, radius)
+    rows = cls.in_bounds(cls.coordinates(), north, south, east, west)
+    return [row for row in rows if geo.distance(lat, lng, row[1], row[2]) <= radius]
+
+  @classmethod
+  def within_radius(cls, lat, lng, radius):
+    """(distance, id) of every blip within radius miles, closest first"""
+    return rank_by_distance(lat, lng, cls.coordinates_within(lat, lng, radius))
+
+  @classmethod
+  def nearest_hits(cls, lat, lng, limit):
+    """
+    (distance, id) of the limit blips closest to a point. Searches a growing
+    radius so only nearby geohash cells are read; falls back to a scan of the
+    coordinate columns when the whole table holds fewer than limit blips.
+    """
+    radius = geo.INITIAL_SEARCH_RADIUS
+    while radius < geo.MAX_SEARCH_RADIUS:
+      hits = cls.within_radius(lat, lng, radius)
+      if len(hits) >= limit:
+        break
+      radius *= geo.SEARCH_RADIUS_GROWTH
+    else:
+      hits = rank_by_distance(lat, lng, cls.coordinates())
+    return hits[:limit]
+
+  @classmethod
+  def nearest_ids(cls, lat, lng, limit):
+    return [b_id for distance, b_id in cls.nearest_hits(lat, lng, limit)]
+
+  @classmethod
+  def by_ids(cls, ids, query=None):
+    """Load blips (or rows of a select() query) for ids, preserving the order of ids"""
+    if not ids:
+      return []
+    query = cls.eager() if query is None else query
+    blips = dict((blip.id, blip) for blip in query.filter(cls.id.in_(ids)))
+    return [blips[b_id] for b_id in ids if b_id in blips]
+
+  @classmethod
+  def within_bounds(cls, north, south, east, west, limit=25, query=None):
+    """The newest limit blips inside a bounding box (east < west crosses the antimeridian)"""
+    query = cls.eager() if query is None else query
+    return cls.in_bounds(query, north, south, east, west).order_by(cls.id.desc()).limit(limit).all()
+
+  @classmethod
+  def eager(cls):
+    """Query that loads everything serialize touches up front"""
+    return cls.query.options(db.joinedload('song'))
+
+  # fields a client may select with fields=; all but song are plain columns
+  FIELDS = ['id', 'song', 'song_id', 'user_id', 'longitude', 'latitude',
+            'timestamp', 'favorite_count', 'comment_count']
+
+  @classmethod
+  def select(cls, fields=None):
+    """
+    Query for rendering fields (every field when None). Unless the song is
+    wanted only the selected columns are read, with no join to song.
+    """
+    if fields is None or 'song' in fields:
+      return cls.eager()
+    columns = ['id'] + [field for field in fields if field != 'id']
+    return db.session.query(*[getattr(cls, column) for column in columns])
+
+  @classmethod
+  @timed('serialize')
+  def render(cls, row, fields=None):
+    """The dict for a blip or select() row, restricted to fields"""
+    if fields is None:
+      return row.serialize
+    rendered = {}
+    for field in fields:
+      if field == 'song':
+        rendered[field] = row.song.serialize
+      elif field == 'timestamp':
+        rendered[field] = row.timestamp.isoformat()
+      else:
+        rendered[field] = getattr(row, field)
+    return rendered
+
+  @property
+  @timed('serialize')
+  def serialize(self):
+    return {
+      'id'             : self.id,
+      'song'           : self.song.serialize,
+      'user_id'        : self.user_id,
+      'longitude'      : self.longitude,
+      'latitude'       : self.latitude,
+      'timestamp'      : self.timestamp.isoformat(),
+      'favorite_count' : self.favorite_count,
+      'comment_count'  : self.comment_count
+    }
+
+class Comment(db.Model):
+  __tablename__ = "comment"
+
+  id        = db.Column(db.Integer, primary_key = True)
+  blip_id   = db.Column(db.Integer, db.ForeignKey('blip.id'))
+  user_id   = db.Column(db.Integer, db.ForeignKey('user.id'))
+  comment   = db.Column(db.Text)
+  timestamp = db.Column(db.DateTime, default=datetime.now)
+  blip      = db.relationship("Blip")
+
+  def __init__(self, user_id,blip_id,comment):
+    self.user_id = user_id
+    self.blip_id = blip_id
+    self.comment = comment
+
+  @classmethod
+  def eager(cls):
+    """Query that loads everything serialize touches up front"""
+    return cls.query.options(db.joinedload_all('blip.song'))
+
+  @property
+  @timed('serialize')
+  def serialize(self):
+    return {
+      'id'       : self.id,
+      'blip'     : self.blip.serialize,
+      'comment'  : self.comment,
+      'user_id'  : self.user_id,
+      'timestamp': self.timestamp.isoformat()
+    }
+
+class SearchTerm(db.Model):
+  """
+  Inverted index entry: a term of the text of an object, weighted by the
+  fields it appears in (see search.py). The primary key orders postings by
+  term, so prefix lookups are range reads.
+  """
+  __tablename__ = 'search_term'
+
+  term      = db.Column(db.String(40), primary_key = True)
+  kind      = db.Column(db.String(20), primary_key = True)
+  object_id = db.Column(db.Integer, primary_key = True, autoincrement = False)
+  weight    = db.Column(db.Float, nullable = False)
+
+class Favorite(db.Model):
+  __tablename__ = "favorite"
+
+  id        = db.Column(db.Integer, primary_key = True)
+  blip_id   = db.Column(db.Integer, db.ForeignKey('blip.id'))
+  user_id   = db.Column(db.Integer, db.ForeignKey('user.id'))
+  timestamp = db.Column(db.DateTime, default=datetime.now)
+  blip      = db.relationship("Blip")
+  user      = db.relationship("User")
+
+  def __init__(self, user_id, blip_id):
+    self.user_id = user_id
+    self.blip_id = blip_id
+
+  @property
+  @timed('serialize')
+  def serialize(self):
+    return {
+      'id'      : self.id,
+      'user_id' : self.user_id,
+      'blip_id' : self.blip_id
+    }
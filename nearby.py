@@ -0,0 +1,71 @@
+##################################################
+# CACHED NEAREST-BLIP CANDIDATES
+##################################################
+
+import geo
+from models import *
+
+# queries are bucketed by the geohash cell they fall in
+NEARBY_CELL_PRECISION = 6
+# a cell caches enough candidates to answer any limit up to this
+NEARBY_CANDIDATES     = 100
+# new blips invalidate the neighbourhoods they fall in at these precisions
+NEARBY_TAG_PRECISIONS = [4, 3, 2, 1]
+NEARBY_WORLD_TAG      = 'nearby:world'
+
+def nearby_tag(geohash):
+  return 'nearby:' + geohash
+
+class NearbyCache(object):
+  """
+  Nearest-blip candidates per geohash cell. With D the distance from a cell's
+  center to its candidates-th nearest blip and h the cell's radius, every blip
+  that can be among the candidates nearest to any point of the cell lies
+  within D + 2h of the center; those (id, latitude, longitude) rows are cached
+  and the exact ordering is recomputed per query. An entry is tagged with the
+  smallest geohash neighbourhood containing that disk, so a new blip only
+  invalidates cells whose candidates it could join.
+  """
+
+  def __init__(self, cache, candidates=NEARBY_CANDIDATES):
+    self.cache      = cache
+    self.candidates = candidates
+
+  def nearest_ids(self, lat, lng, limit):
+    if limit > self.candidates:
+      return Blip.nearest_ids(lat, lng, limit)
+    cell = geo.encode(lat, lng, NEARBY_CELL_PRECISION)
+    rows = self.cache.get('candidates:' + cell)
+    if rows is None:
+      rows = self.load(cell)
+    return [b_id for distance, b_id in rank_by_distance(lat, lng, rows)[:limit]]
+
+  def load(self, cell):
+    center_lat, center_lng = geo.decode(cell)
+    neighbourhoods = dict((precision, [nearby_tag(n) for n in geo.neighbourhood(center_lat, center_lng, precision)])
+                          for precision in NEARBY_TAG_PRECISIONS)
+    versions = self.cache.versions([NEARBY_WORLD_TAG] + sum(neighbourhoods.values(), []))
+
+    hits = Blip.nearest_hits(center_lat, center_lng, self.candidates)
+    tags = [NEARBY_WORLD_TAG]
+    if len(hits) < self.candidates:
+      rows = list(Blip.coordinates())
+    else:
+      radius = hits[-1][0] + 2 * geo.cell_radius(cell)
+      rows   = Blip.coordinates_within(center_lat, center_lng, radius)
+      for precision in NEARBY_TAG_PRECISIONS:
+        if radius <= geo.neighbourhood_reach(center_lat, precision):
+          tags = neighbourhoods[precision]
+          break
+    rows = [tuple(row) for row in rows]
+    self.cache.set('candidates:' + cell, rows, dict((tag, versions[tag]) for tag in tags),
+                   db.session().cache_ttl())
+    return rows
+
+  def invalidate(self, *points):
+    """Call after committing blips at (lat, lng) points"""
+    tags = set([NEARBY_WORLD_TAG])
+    for lat, lng in points:
+      geohash = geo.encode(lat, lng, max(NEARBY_TAG_PRECISIONS))
+      tags.update(nearby_tag(geohash[:precision]) for precision in NEARBY_TAG_PRECISIONS)
+    self.cache.invalidate(*tags)
@@ -0,0 +1,26 @@
+##################################################
+# SONG PROVIDERS
+##################################################
+
+from settings import *
+
+def normalize(artist, title):
+  """Case and whitespace insensitive key for an artist/title pair"""
+  return u'\x1f'.join(u' '.join(value.lower().split()) for value in [artist, title])
+
+class YoutubeProvider(object):
+  """Finds the most relevant YouTube video for a song"""
+  key = "Youtube"
+
+  def __init__(self, service):
+    self.service = service
+
+  def lookup(self, artist, title):
+    query = gdata.youtube.service.YouTubeVideoQuery()
+    query.vq          = artist + " " + title
+    query.orderby     = 'relevance'
+    query.max_results = 1
+    feed = self.service.YouTubeQuery(query)
+    return feed.entry[0].id.text.split('/')[-1]
+
+youtube = YoutubeProvider(yt_service)
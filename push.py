@@ -0,0 +1,204 @@
+##################################################
+# PUSH OF NEW ACTIVITY TO SUBSCRIBED REGIONS
+##################################################
+
+import json
+import time
+import Queue
+import select
+import logging
+import threading
+import geo
+
+log = logging.getLogger(__name__)
+
+# Postgres rejects notification payloads of 8000 bytes or more
+NOTIFY_PAYLOAD_LIMIT = 7900
+# seconds between checks of the listening connection, and before reconnecting it
+RELAY_POLL           = 5
+RELAY_RETRY          = 5
+
+class Subscription(object):
+  """
+  A client's region (east < west crosses the antimeridian) and the server-sent
+  event messages waiting for it. A client that lets buffer messages pile up is
+  closed rather than buffered without bound; it reconnects and catches up with
+  GET /api/blip.
+  """
+
+  def __init__(self, north, south, east, west, buffer=100):
+    self.north    = north
+    self.south    = south
+    self.east     = east
+    self.west     = west
+    self.cells    = geo.cover(north, south, east, west) or ['']
+    self.messages = Queue.Queue(buffer)
+    self.closed   = False
+
+  def contains(self, lat, lng):
+    if not self.south <= lat <= self.north:
+      return False
+    if self.east >= self.west:
+      return self.west <= lng <= self.east
+    return lng >= self.west or lng <= self.east
+
+  def deliver(self, message):
+    try:
+      self.messages.put_nowait(message)
+    except Queue.Full:
+      self.closed = True
+
+class SubscriptionIndex(object):
+  """
+  Subscriptions by the geohash cells covering their regions (the empty prefix
+  for regions too large to cover). An event at a point visits only the
+  subscriptions filed under one of its geohash's prefixes.
+  """
+
+  def __init__(self):
+    self.cells = {}
+    self._lock = threading.Lock()
+
+  def add(self, subscription):
+    with self._lock:
+      for cell in subscription.cells:
+        self.cells.setdefault(cell, set()).add(subscription)
+
+  def remove(self, subscription):
+    with self._lock:
+      for cell in subscription.cells:
+        subscriptions = self.cells.get(cell, set())
+        subscriptions.discard(subscription)
+        if not subscriptions:
+          self.cells.pop(cell, None)
+
+  def matching(self, lat, lng):
+    geohash = geo.encode(lat, lng)
+    found   = set()
+    with self._lock:
+      for length in range(len(geohash) + 1):
+        found.update(self.cells.get(geohash[:length], ()))
+    return [subscription for subscription in found if subscription.contains(lat, lng)]
+
+  def __len__(self):
+    return len(self.cells)
+
+class LocalBroker(object):
+  """
+  Delivers events to the subscribers of this process. Every worker serving
+  subscriptions has to see every write, so deployments with several workers
+  need a broker with the same interface relaying events between processes.
+  """
+
+  def __init__(self, buffer=100):
+    self.buffer = buffer
+    self.index  = SubscriptionIndex()
+
+  def subscribe(self, north, south, east, west):
+    subscription = Subscription(north, south, east, west, self.buffer)
+    self.index.add(subscription)
+    return subscription
+
+  def unsubscribe(self, subscription):
+    self.index.remove(subscription)
+
+  def has_subscribers(self):
+    return len(self.index) > 0
+
+  def publish(self, kind, lat, lng, obj):
+    """Send the serialized obj as a kind event to the subscriptions containing (lat, lng)"""
+    subscriptions = self.index.matching(lat, lng)
+    if subscriptions:
+      message = 'event: %s\ndata: %s\n\n' % (kind, json.dumps(obj))
+      for subscription in subscriptions:
+        subscription.deliver(message)
+
+def notification(kind, lat, lng, obj):
+  """
+  Payload relaying an event. Objects too large for a notification go as just
+  their id, for clients to fetch.
+  """
+  payload = json.dumps({'kind':kind, 'lat':lat, 'lng':lng, 'obj':obj})
+  if len(payload) >= NOTIFY_PAYLOAD_LIMIT:
+    payload = json.dumps({'kind':kind, 'lat':lat, 'lng':lng, 'obj':{'id':obj['id']}})
+  return payload
+
+class PostgresBroker(LocalBroker):
+  """
+  Relays events between processes with Postgres NOTIFY. publish() notifies
+  a channel, and a thread in each process LISTENing on it delivers the events
+  to that process's subscribers, its own included. The listening connection
+  is opened outside the pool on the first subscribe; events notified while
+  it is down are lost, and their clients catch up when they reconnect.
+  """
+
+  def __init__(self, engine, buffer=100, channel='latitune_push'):
+    LocalBroker.__init__(self, buffer)
+    self.engine   = engine
+    self.channel  = channel
+    self.listener = None
+    self._lock    = threading.Lock()
+
+  def subscribe(self, north, south, east, west):
+    self.listen()
+    return LocalBroker.subscribe(self, north, south, east, west)
+
+  def has_subscribers(self):
+    """Other processes' subscribers are not known here"""
+    return True
+
+  def publish(self, kind, lat, lng, obj):
+    conn = self.engine.connect()
+    try:
+      conn.execution_options(autocommit=True).execute("SELECT pg_notify(%(channel)s, %(payload)s)",
+                                                      {'channel': self.channel,
+                                                       'payload': notification(kind, lat, lng, obj)})
+    finally:
+      conn.close()
+
+  def deliver(self, payload):
+    event = json.loads(payload)
+    LocalBroker.publish(self, event['kind'], event['lat'], event['lng'], event['obj'])
+
+  def listen(self):
+    with self._lock:
+      if self.listener is None:
+        self.listener = threading.Thread(target=self._listen, name="push-relay")
+        self.listener.daemon = True
+        self.listener.start()
+
+  def _listen(self):
+    dialect = self.engine.dialect
+    while True:
+      conn = None
+      try:
+        cargs, cparams = dialect.create_connect_args(self.engine.url)
+        conn = dialect.connect(*cargs, **cparams)
+        conn.autocommit = True
+        conn.cursor().execute('LISTEN ' + self.channel)
+        while True:
+          if select.select([conn], [], [], RELAY_POLL)[0]:
+            conn.poll()
+            while conn.notifies:
+              self.deliver(conn.notifies.pop(0).payload)
+      except Exception:
+        log.exception("push relay connection failed")
+        if conn is not None:
+          conn.close()
+        time.sleep(RELAY_RETRY)
+
+def event_stream(broker, subscription, heartbeat, retry):
+  """
+  Server-sent event body for a subscription. A comment line goes out every
+  heartbeat seconds without events, keeping proxies from closing the stream;
+  retry is how long (seconds) clients wait before reconnecting.
+  """
+  try:
+    yield 'retry: %d\n\n' % (retry * 1000)
+    while not subscription.closed:
+      try:
+        yield subscription.messages.get(timeout=heartbeat)
+      except Queue.Empty:
+        yield ': keepalive\n\n'
+  finally:
+    broker.unsubscribe(subscription)
@@ -0,0 +1,165 @@
+##################################################
+# BACKGROUND PROVIDER RESOLUTION
+##################################################
+
+import time
+import Queue
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from settings import *
+from models import *
+from cache import LRUCache
+import providers
+
+log = logging.getLogger(__name__)
+
+class ProviderCache(object):
+  """
+  Provider ids by normalized artist/title: an in-process LRU in front of the
+  provider_lookup table. Rows older than PROVIDER_CACHE_TTL are not served,
+  so those songs are looked up again and the row is refreshed.
+  """
+
+  def __init__(self, app):
+    self.app    = app
+    self.memory = LRUCache(app.config['PROVIDER_MEMORY_SIZE'], app.config['PROVIDER_MEMORY_TTL'])
+
+  def get(self, provider_key, artist, title):
+    key = (provider_key, providers.normalize(artist, title))
+    provider_song_id = self.memory.get(key)
+    if provider_song_id is not None:
+      return provider_song_id
+    fresh_after = datetime.now() - timedelta(seconds=self.app.config['PROVIDER_CACHE_TTL'])
+    row = ProviderLookup.query.filter(ProviderLookup.provider_key == key[0],
+                                      ProviderLookup.key == key[1],
+                                      ProviderLookup.resolved_at > fresh_after).first()
+    if row is None:
+      return None
+    self.memory.set(key, row.provider_song_id)
+    return row.provider_song_id
+
+  def set(self, provider_key, artist, title, provider_song_id):
+    key = (provider_key, providers.normalize(artist, title))
+    self.memory.set(key, provider_song_id)
+    try:
+      db.session.merge(ProviderLookup(key[0], key[1], provider_song_id))
+      db.session.commit()
+    except IntegrityError:
+      # another worker cached the same song first
+      db.session.rollback()
+
+class SongResolver(object):
+  """
+  Pool of worker threads that look up provider ids for songs created with
+  resolve=False. Failed lookups are retried with exponential backoff and the
+  song is marked failed after SONG_RESOLVER_ATTEMPTS tries. Workers start on
+  the first submit; with SONG_RESOLVER_WORKERS = 0 nothing runs until drain().
+  listeners are called with the song id after each update is committed.
+  """
+
+  def __init__(self, app, cache):
+    self.app     = app
+    self.cache   = cache
+    self.queue   = Queue.Queue()
+    self.threads   = []
+    self.listeners = []
+    self._lock     = threading.Lock()
+
+  def submit(self, song_id):
+    self.queue.put(song_id)
+    self.start()
+
+  def start(self):
+    with self._lock:
+      while len(self.threads) < self.app.config['SONG_RESOLVER_WORKERS']:
+        thread = threading.Thread(target=self._work, name="song-resolver-%i" % len(self.threads))
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+  def requeue_pending(self):
+    """
+    Submit songs left pending, e.g. by a restart while they were queued.
+    Songs claimed by a live lease are being resolved elsewhere and skipped.
+    """
+    for song_id, in (db.session.query(Song.id).filter_by(provider_state=PROVIDER_PENDING)
+                                              .filter(self.claimable())):
+      self.submit(song_id)
+
+  def claimable(self):
+    expired = datetime.now() - timedelta(seconds=self.app.config['SONG_RESOLVER_LEASE'])
+    return db.or_(Song.provider_claimed == None, Song.provider_claimed < expired)
+
+  def claim(self, song_id):
+    """
+    Take the lease on a pending song; False if it is resolved or another
+    worker, of any process, holds a live lease on it
+    """
+    claimed = (Song.query.filter_by(id=song_id, provider_state=PROVIDER_PENDING)
+                         .filter(self.claimable())
+                         .update({'provider_claimed': datetime.now()}, synchronize_session=False))
+    db.session.commit()
+    return claimed == 1
+
+  def join(self):
+    self.queue.join()
+
+  def drain(self):
+    """Resolve everything queued in the calling thread"""
+    while True:
+      try:
+        song_id = self.queue.get_nowait()
+      except Queue.Empty:
+        return
+      self._run(song_id)
+
+  def _work(self):
+    while True:
+      self._run(self.queue.get())
+
+  def _run(self, song_id):
+    try:
+      self.resolve(song_id)
+    except Exception:
+      log.exception("resolving song %s failed", song_id)
+    finally:
+      db.session.remove()
+      self.queue.task_done()
+
+  def resolve(self, song_id):
+    if not self.claim(song_id):
+      return
+    artist, title = db.session.query(Song.artist, Song.title).filter_by(id=song_id).one()
+    # don't hold a transaction open across the network call
+    db.session.rollback()
+
+    provider_song_id = self.cache.get(Song.provider.key, artist, title)
+    if provider_song_id is not None:
+      self.update(song_id, PROVIDER_RESOLVED, provider_song_id)
+      return
+
+    attempts = self.app.config['SONG_RESOLVER_ATTEMPTS']
+    for attempt in range(attempts):
+      try:
+        provider_song_id = Song.provider.lookup(artist, title)
+        self.update(song_id, PROVIDER_RESOLVED, provider_song_id)
+        self.cache.set(Song.provider.key, artist, title, provider_song_id)
+        return
+      except Exception:
+        log.warning("provider lookup for song %s failed (attempt %i)", song_id, attempt + 1, exc_info=True)
+        if attempt + 1 < attempts:
+          time.sleep(self.app.config['SONG_RESOLVER_BACKOFF'] * 2 ** attempt)
+    self.update(song_id, PROVIDER_FAILED, "")
+
+  def update(self, song_id, state, provider_song_id):
+    Song.query.filter_by(id=song_id, provider_state=PROVIDER_PENDING).update(
+      {'provider_state': state, 'provider_song_id': provider_song_id})
+    Blip.touch_song(song_id)
+    db.session.commit()
+    for listener in self.listeners:
+      listener(song_id)
+
+provider_cache = ProviderCache(app)
+song_resolver  = SongResolver(app, provider_cache)
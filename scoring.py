@@ -0,0 +1,39 @@
+##################################################
+# HOT SCORES
+##################################################
+
+import math
+from datetime import datetime
+
+# a blip's hotness is the sum of weight * e^(t / HOT_DECAY_SECONDS) over its
+# creation, favorites and comments. Every score decays at the same rate, so
+# ranking by the undecayed sum ranks by current hotness without ever touching
+# old rows. Scores are kept as logarithms to stay in floating point range.
+HOT_EPOCH         = datetime(2013, 1, 1)
+HOT_DECAY_SECONDS = 24 * 60 * 60
+
+CREATE_WEIGHT   = 1.0
+FAVORITE_WEIGHT = 2.0
+COMMENT_WEIGHT  = 1.0
+
+def event_score(weight, when):
+  """Log score contributed by one event of weight at datetime when"""
+  delta = when - HOT_EPOCH
+  seconds = delta.days * 24 * 60 * 60 + delta.seconds + delta.microseconds / 1e6
+  return math.log(weight) + seconds / HOT_DECAY_SECONDS
+
+def initial_score(created):
+  return event_score(CREATE_WEIGHT, created)
+
+def add_event(score, weight, when):
+  """score after adding an event, i.e. log(e^score + weight * e^t)"""
+  event = event_score(weight, when)
+  high, low = max(score, event), min(score, event)
+  return high + math.log1p(math.exp(low - high))
+
+def remove_event(score, weight, when, floor):
+  """score after withdrawing an event, never below floor"""
+  event = event_score(weight, when)
+  if event >= score:
+    return floor
+  return max(floor, score + math.log1p(-math.exp(event - score)))
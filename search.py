@@ -0,0 +1,100 @@
+##################################################
+# FULL-TEXT SEARCH
+##################################################
+
+import re
+from collections import defaultdict
+from models import *
+
+# terms are cut to the term column's length
+MAX_TERM_LENGTH = 40
+# the last word of a query also matches longer terms, once it is this long
+MIN_PREFIX      = 2
+# the searchable text of each kind of object, as (attribute, weight) pairs
+SEARCH_FIELDS = {
+  'song'    : [('title', 3.0), ('artist', 2.0), ('album', 1.0)],
+  'user'    : [('name', 1.0)],
+  'comment' : [('comment', 1.0)]
+}
+SEARCH_MODELS = {
+  'song'    : Song,
+  'user'    : User,
+  'comment' : Comment
+}
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+  """Distinct lower cased words of text, in order"""
+  terms = []
+  for word in WORD.findall((text or u'').lower()):
+    word = word[:MAX_TERM_LENGTH]
+    if word not in terms:
+      terms.append(word)
+  return terms
+
+def index(kind, obj):
+  """
+  Add the terms of a flushed object to the index, in the caller's
+  transaction. A term's weight is the sum of the weights of the fields it
+  appears in, each shared between the terms of its field.
+  """
+  weights = defaultdict(float)
+  for attribute, weight in SEARCH_FIELDS[kind]:
+    terms = tokenize(getattr(obj, attribute))
+    for term in terms:
+      weights[term] += weight / len(terms)
+  if weights:
+    db.session.execute(SearchTerm.__table__.insert(),
+                       [{'term':term, 'kind':kind, 'object_id':obj.id, 'weight':weight}
+                        for term, weight in weights.items()])
+
+def reindex(kind, batch=1000):
+  """Rebuild the index of a kind of object from its table"""
+  SearchTerm.query.filter_by(kind=kind).delete()
+  for obj in SEARCH_MODELS[kind].query.yield_per(batch):
+    index(kind, obj)
+  db.session.commit()
+
+def search(query, kinds, limit):
+  """
+  (kind, id, score) of the best limit objects of kinds containing every word
+  of query, the last one as a prefix, best first. Each word is an exact or
+  prefix range read of the index; the postings are combined in one grouped
+  query and no table is scanned.
+  """
+  terms = tokenize(query)
+  if not terms or not kinds:
+    return []
+  exact, last = terms[:-1], terms[-1]
+  if len(last) >= MIN_PREFIX:
+    # every term starting with last sorts between last and last followed by
+    # the highest code point
+    matches_last = db.and_(SearchTerm.term >= last, SearchTerm.term < last + u'\uffff')
+  else:
+    matches_last = SearchTerm.term == last
+  conditions = [SearchTerm.term == term for term in exact] + [matches_last]
+  score = db.func.sum(SearchTerm.weight)
+  hits  = (db.session.query(SearchTerm.kind, SearchTerm.object_id, score)
+                     .filter(SearchTerm.kind.in_(kinds))
+                     .filter(db.or_(*conditions))
+                     .group_by(SearchTerm.kind, SearchTerm.object_id))
+  if exact:
+    # which query word a posting matched, so prefix matches count once
+    word = db.case([(SearchTerm.term == term, i) for i, term in enumerate(exact)], else_=len(exact))
+    hits = hits.having(db.func.count(db.distinct(word)) == len(terms))
+  return hits.order_by(score.desc(), SearchTerm.object_id.desc()).limit(limit).all()
+
+def load(hits):
+  """Serialized results for search() hits, in the same order"""
+  ids = defaultdict(list)
+  for kind, object_id, score in hits:
+    ids[kind].append(object_id)
+  found = {}
+  for kind, object_ids in ids.items():
+    model = SEARCH_MODELS[kind]
+    query = model.eager() if hasattr(model, 'eager') else model.query
+    for obj in query.filter(model.id.in_(object_ids)):
+      found[(kind, obj.id)] = obj.serialize
+  return [{'kind':kind, 'score':score, kind:found[(kind, object_id)]}
+          for kind, object_id, score in hits if (kind, object_id) in found]
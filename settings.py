@@ -4,9 +4,13 @@
 
 import os
 import sys
+import random
 from flask import Flask
 from flask_heroku import Heroku
-from flask.ext.sqlalchemy import SQLAlchemy
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
+import functools
+from sqlalchemy import event, exc, orm
+from sqlalchemy.pool import QueuePool
 import gdata.youtube
 import gdata.youtube.service
 
@@ -19,6 +23,127 @@ if os.environ.get('LATITUNE_LOCAL') == "true":
   app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://localhost/latitune_dev'
 else:
   heroku    = Heroku(app)
-app.debug = True
+app.debug = os.environ.get('LATITUNE_LOCAL') == "true"
 
-db        = SQLAlchemy (app)
+# background lookup of provider ids for new songs (see resolver.py)
+app.config.setdefault('SONG_RESOLVER_WORKERS', 4)
+app.config.setdefault('SONG_RESOLVER_ATTEMPTS', 5)
+app.config.setdefault('SONG_RESOLVER_BACKOFF', 2.0)
+# a worker claims a song for this many seconds before looking it up, so the
+# workers of other processes leave it alone
+app.config.setdefault('SONG_RESOLVER_LEASE', 10 * 60)
+
+# GET /api/blip answers a radius (in miles) above MAX_RADIUS with Malformed
+# Parameters, as a larger one reads most of the blip table
+app.config.setdefault('MAX_RADIUS', 500)
+
+# provider lookups are cached in memory for PROVIDER_MEMORY_TTL seconds and in
+# the provider_lookup table until they are PROVIDER_CACHE_TTL seconds old
+app.config.setdefault('PROVIDER_MEMORY_SIZE', 10000)
+app.config.setdefault('PROVIDER_MEMORY_TTL', 60 * 60)
+app.config.setdefault('PROVIDER_CACHE_TTL', 30 * 24 * 60 * 60)
+
+# read endpoint responses are cached in memcached when MEMCACHED_SERVERS (comma
+# separated host:port) is set, else in this process. An in-process cache only
+# sees this process's invalidations, so without MEMCACHED_SERVERS caching is
+# disabled when WORKER_PROCESSES > 1 (gunicorn.conf.py exports WEB_CONCURRENCY)
+app.config.setdefault('MEMCACHED_SERVERS', os.environ.get('MEMCACHED_SERVERS'))
+app.config.setdefault('WORKER_PROCESSES', int(os.environ.get('WEB_CONCURRENCY', 1)))
+app.config.setdefault('RESPONSE_CACHE_SIZE', 10000)
+app.config.setdefault('RESPONSE_CACHE_TTL', 300)
+
+# GET /api/blip/stream subscribers get up to PUSH_BUFFER undelivered events
+# before they are dropped, a keepalive after PUSH_HEARTBEAT idle seconds, and
+# reconnect PUSH_RETRY seconds after losing the stream
+app.config.setdefault('PUSH_BUFFER', 100)
+app.config.setdefault('PUSH_HEARTBEAT', 15)
+app.config.setdefault('PUSH_RETRY', 3)
+# a stream holds its worker for as long as it is open, so streams are only
+# accepted by gevent and eventlet workers (gunicorn.conf.py exports WORKER_CLASS)
+app.config.setdefault('WORKER_CLASS', os.environ.get('WORKER_CLASS'))
+
+# connection pool of each process for server databases (sqlite keeps its own
+# pools): up to POOL_SIZE + MAX_OVERFLOW connections, waiting POOL_TIMEOUT
+# seconds for one, replacing connections older than POOL_RECYCLE seconds and,
+# with POOL_PRE_PING, testing each one as it is checked out. Keep workers *
+# (POOL_SIZE + MAX_OVERFLOW) below the database's connection limit.
+app.config.setdefault('DATABASE_POOL_SIZE', int(os.environ.get('DATABASE_POOL_SIZE', 5)))
+app.config.setdefault('DATABASE_MAX_OVERFLOW', int(os.environ.get('DATABASE_MAX_OVERFLOW', 5)))
+app.config.setdefault('DATABASE_POOL_TIMEOUT', 10)
+app.config.setdefault('DATABASE_POOL_RECYCLE', 30 * 60)
+app.config.setdefault('DATABASE_POOL_PRE_PING', True)
+
+# read-only requests go to a random replica when DATABASE_REPLICA_URLS (comma
+# separated) is set. After a write a client reads from the primary for
+# DATABASE_REPLICA_LAG seconds, and anything cached from a replica read
+# expires after that long.
+app.config.setdefault('DATABASE_REPLICA_LAG', 10)
+if 'DATABASE_REPLICAS' not in app.config:
+  replica_urls = filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(','))
+  app.config['DATABASE_REPLICAS'] = ['replica%d' % i for i in range(len(replica_urls))]
+  app.config['SQLALCHEMY_BINDS']  = dict(zip(app.config['DATABASE_REPLICAS'], replica_urls)) or None
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+  """Checkout listener; a dead connection is discarded and another one tried"""
+  cursor = dbapi_connection.cursor()
+  try:
+    cursor.execute("SELECT 1")
+  except Exception:
+    raise exc.DisconnectionError()
+  finally:
+    cursor.close()
+
+class PingingQueuePool(QueuePool):
+  def __init__(self, *args, **kwargs):
+    QueuePool.__init__(self, *args, **kwargs)
+    # recreate() hands over the listeners along with _dispatch
+    if '_dispatch' not in kwargs:
+      event.listen(self, 'checkout', ping_connection)
+
+class RoutingSession(_SignallingSession):
+  """
+  Session that reads from a replica once use_replica() is called; flushes,
+  and so every write, still go to the primary.
+  """
+
+  def __init__(self, db, **options):
+    _SignallingSession.__init__(self, db, **options)
+    self.db      = db
+    self.replica = None
+
+  def use_replica(self):
+    replicas = self.app.config['DATABASE_REPLICAS']
+    if replicas:
+      self.replica = self.db.get_engine(self.app, random.choice(replicas))
+
+  def cache_ttl(self):
+    """Longest time what this session read may be cached (None: no limit)"""
+    return self.app.config['DATABASE_REPLICA_LAG'] if self.replica is not None else None
+
+  def get_bind(self, mapper=None, clause=None):
+    if self.replica is not None and not self._flushing:
+      return self.replica
+    return _SignallingSession.get_bind(self, mapper, clause)
+
+class PooledSQLAlchemy(SQLAlchemy):
+  """
+  Flask-SQLAlchemy applying the DATABASE_POOL_* settings to server databases,
+  with RoutingSession sessions
+  """
+
+  def create_scoped_session(self, options=None):
+    options   = dict(options or {})
+    scopefunc = options.pop('scopefunc', None)
+    return orm.scoped_session(functools.partial(RoutingSession, self, **options), scopefunc=scopefunc)
+
+  def apply_driver_hacks(self, app, info, options):
+    if info.drivername != 'sqlite':
+      options.update({'pool_size'    : app.config['DATABASE_POOL_SIZE'],
+                      'max_overflow' : app.config['DATABASE_MAX_OVERFLOW'],
+                      'pool_timeout' : app.config['DATABASE_POOL_TIMEOUT'],
+                      'pool_recycle' : app.config['DATABASE_POOL_RECYCLE']})
+      if app.config['DATABASE_POOL_PRE_PING']:
+        options['poolclass'] = PingingQueuePool
+    SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+db        = PooledSQLAlchemy (app)
@@ -0,0 +1,65 @@
+##################################################
+# HOT BLIPS PER CELL
+##################################################
+
+import heapq
+import threading
+from itertools import chain
+import geo
+from models import *
+from cache import LRUCache
+
+# the hot feed covers the geohash cell of a point and its neighbours
+HOT_CELL_PRECISION = 4
+# each cell keeps its HOT_TOP_K hottest blips, enough for any feed limit
+HOT_TOP_K          = 100
+HOT_INDEX_CELLS    = 4096
+# cells are reloaded at least this often, picking up other processes' writes
+HOT_INDEX_TTL      = 60
+
+class HotIndex(object):
+  """
+  Top-K (hot_score, id) lists per geohash cell, loaded lazily from the
+  hot_score index and kept current by update() after each committed score
+  change. A feed merges the lists of nine cells, so it costs O(K) and never
+  touches the Favorite or Comment tables.
+  """
+
+  def __init__(self, k=HOT_TOP_K, max_cells=HOT_INDEX_CELLS, ttl=HOT_INDEX_TTL):
+    self.k     = k
+    self.cells = LRUCache(max_cells, ttl)
+    self._lock = threading.Lock()
+
+  def top(self, cell):
+    entries = self.cells.get(cell)
+    if entries is None:
+      entries = self.cells.add(cell, [tuple(row) for row in Blip.hottest(cell, self.k)])
+    return entries
+
+  def feed(self, lat, lng, limit):
+    """Ids of the limit hottest blips around a point, hottest first"""
+    cells = geo.neighbourhood(lat, lng, HOT_CELL_PRECISION)
+    hits  = heapq.nlargest(limit, chain(*[self.top(cell) for cell in cells]))
+    return [b_id for score, b_id in hits]
+
+  def update(self, geohash, blip_id, score):
+    """Apply a committed score change; cells not loaded are left to load fresh"""
+    cell = geohash[:HOT_CELL_PRECISION]
+    with self._lock:
+      entries = self.cells.get(cell)
+      if entries is None:
+        return
+      others = [entry for entry in entries if entry[1] != blip_id]
+      if len(entries) == self.k and len(others) < len(entries) and score < entries[-1][0]:
+        # the blip fell below the cut; a blip outside the list may now belong in it
+        self.cells.delete(cell)
+        return
+      self.cells.set(cell, sorted(others + [(score, blip_id)], reverse=True)[:self.k])
+
+  def invalidate(self, *geohashes):
+    """Drop the cells of blips inserted without their ids at hand"""
+    for geohash in set(geohash[:HOT_CELL_PRECISION] for geohash in geohashes):
+      self.cells.delete(geohash)
+
+  def clear(self):
+    self.cells.clear()